@@ -1,14 +1,15 @@
 import pandas as pd
 import streamlit as st
 import logging
-from threading import Lock
-import os
+from pnl_store import apply_pnl_update, clear_pnl_keys, format_pnl_keys, mapped_pnl_rows, updated_rows_report, without_cells
+from pnl_journal import read_pnl_view, unpunched_rows
+from findings_view import MISMATCH_GROUPS, export_buttons, number_config, show_finding_groups, show_findings, styled_numbers
+from dump_store import conform_dump_rows, format_coerced, map_dump_rows, read_dump_summary
+from write_coordinator import write_dump_rows, write_pnl_changes
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-lock = Lock()
-
 def safe_get_value(row, col):
     return row[col] if col in row and pd.notna(row[col]) else 0
 
@@ -19,6 +20,9 @@ def check_mismatch(row, index, column_name, expected_value, mismatched_data):
             'Row': index + 3,
             'Date': row['date'],
             'Column': column_name,
+            'Session': row.get('session'),
+            'Order Type': row.get('order type'),
+            'Vendor': row.get('vendor'),
             'Expected': expected_value,
             'Actual': actual_value
         })
@@ -159,80 +163,101 @@ def find_popup_selling_issues(df):
             })
     return popup_selling_issues
 
-def format_dataframe(df):
-    # Format numerical columns to one decimal place
-    for column in df.select_dtypes(include=['float', 'int']).columns:
-        df[column] = df[column].map(lambda x: f"{x:.1f}")
-    return df
-
-def display_dataframes(pivot_df, mismatched_data, karbon_expenses_data, aggregated_data, buying_value_issues, selling_value_issues, popup_selling_issues):
-    
+def show_pivot_df(pivot_df):
     st.write("Buying on Ordered Pax/Vendor MG")
     st.markdown("---")
     st.subheader("Average Buying Price and Selling Price")
-    st.table(format_dataframe(pivot_df))
+    show_findings(pivot_df, "pivot")
     st.markdown("---")
 
+def show_mismatched_data(mismatched_data):
     if mismatched_data:
         mismatched_df = pd.DataFrame(mismatched_data)
         st.write("<span style='color:red'>Mismatched Data:heavy_exclamation_mark:</span>", unsafe_allow_html=True)
-        st.table(format_dataframe(mismatched_df))
+        show_finding_groups(mismatched_df, MISMATCH_GROUPS, "mismatches")
         st.markdown("---")
     else:
         st.write("<span style='color:green'>No mismatch found.</span> :white_check_mark:", unsafe_allow_html=True)
         st.markdown("---")
 
+def show_buying_value_issues(buying_value_issues):
     if buying_value_issues:
         buying_value_issues_df = pd.DataFrame(buying_value_issues)
         st.write("<span style='color:red'>Buying Value Issues</span> :heavy_exclamation_mark:", unsafe_allow_html=True)
-        st.dataframe(format_dataframe(buying_value_issues_df))
+        show_findings(buying_value_issues_df, "buying_value_issues")
         st.markdown("---")
     else:
         st.write("<span style='color:green'>No buying value issues found.</span> :white_check_mark:", unsafe_allow_html=True)
         st.markdown("---")
 
+def show_selling_value_issues(selling_value_issues):
     if selling_value_issues:
         selling_value_issues_df = pd.DataFrame(selling_value_issues)
         st.write("<span style='color:red'>Selling Value Issues</span> :heavy_exclamation_mark:", unsafe_allow_html=True)
-        st.dataframe(format_dataframe(selling_value_issues_df))
+        show_findings(selling_value_issues_df, "selling_value_issues")
         st.markdown("---")
     else:
         st.write("<span style='color:green'>No selling value issues found.</span> :white_check_mark:", unsafe_allow_html=True)
         st.markdown("---")
 
+def show_popup_selling_issues(popup_selling_issues):
     if popup_selling_issues:
         popup_selling_issues_df = pd.DataFrame(popup_selling_issues)
         st.write("<span style='color:red'>Popup Selling Issues.</span> :heavy_exclamation_mark:", unsafe_allow_html=True)
-        st.dataframe(format_dataframe(popup_selling_issues_df))
+        show_findings(popup_selling_issues_df, "popup_selling_issues")
         st.markdown("---")
     else:
         st.write("<span style='color:green'>No selling price found in Pop-up.</span> :white_check_mark:", unsafe_allow_html=True)
         st.markdown("---")
 
+def show_karbon_expenses_data(karbon_expenses_data):
     if karbon_expenses_data:
         karbon_expenses_df = pd.DataFrame(karbon_expenses_data)
         st.subheader("Karbon Expenses")
-        st.table(format_dataframe(karbon_expenses_df))
+        show_findings(karbon_expenses_df, "karbon_expenses")
         st.markdown("---")
     else:
         st.write("No Karbon expenses found.")
         st.markdown("---")
 
+def show_aggregated_data(aggregated_data):
     aggregated_df = pd.DataFrame(list(aggregated_data.items()), columns=['Parameter', 'Value'])
     st.subheader("Aggregated Values")
-    st.table(format_dataframe(aggregated_df))
+    st.table(styled_numbers(aggregated_df))
     st.markdown("---")
-    
+
+# Finding -> function rendering it, in page order
+RENDERERS = {
+    'pivot_df': show_pivot_df,
+    'mismatched_data': show_mismatched_data,
+    'buying_value_issues': show_buying_value_issues,
+    'selling_value_issues': show_selling_value_issues,
+    'popup_selling_issues': show_popup_selling_issues,
+    'karbon_expenses_data': show_karbon_expenses_data,
+    'aggregated_data': show_aggregated_data,
+}
+
+def display_dataframes(**findings):
+    for name, render in RENDERERS.items():
+        render(findings[name])
+
+
+# Finding -> check producing it; the checks only read the frame, so they can run concurrently
+CHECKS = {
+    'pivot_df': pivot_and_average_prices,
+    'mismatched_data': find_mismatches,
+    'aggregated_data': calculate_aggregated_values,
+    'buying_value_issues': find_buying_value_issues,
+    'selling_value_issues': find_selling_value_issues,
+    'popup_selling_issues': find_popup_selling_issues,
+    'karbon_expenses_data': find_karbon_expenses,
+}
+
+def validate(df):
+    return {name: check(df) for name, check in CHECKS.items()}
 
 def business_logic_14(df):
-    pivot_df = pivot_and_average_prices(df)
-    mismatched_data = find_mismatches(df)
-    aggregated_data = calculate_aggregated_values(df)
-    buying_value_issues = find_buying_value_issues(df)
-    selling_value_issues = find_selling_value_issues(df)
-    popup_selling_issues = find_popup_selling_issues(df)
-    karbon_expenses_data = find_karbon_expenses(df)
-    display_dataframes(pivot_df, mismatched_data, karbon_expenses_data, aggregated_data, buying_value_issues, selling_value_issues, popup_selling_issues)
+    display_dataframes(**validate(df))
 
 
 
@@ -243,135 +268,137 @@ def business_logic_14(df):
 
 #---------------------------------Auto P&L Punch-----------------------------------------------------------------------
 
+PNL_MAPPING = {
+    'days': 'days',
+    'buying pax': 'buying pax',
+    'selling pax': 'selling pax',
+    'regular buying amount': 'regular buying',
+    'regular selling amount': 'selling -gmv',
+    'event buying amount': 'event buying',
+    'event selling amount': 'event -gmv',
+    'penalty on vendor': 'penalty on vendor',
+    'penalty on smartq': 'penalty on smartq',
+    'sams': 'sams'
+}
+
+def compute_pnl_data(df, selected_month):
+    # P&L rows of the selected month; raises on bad input instead of reporting it, so it can run off the script thread
+    # Clean up the data by stripping spaces and converting strings to lowercase
+    df = df.applymap(lambda x: x.strip().lower() if isinstance(x, str) else x)
+    df = df[df['month'] == selected_month]
+
+    if df.empty:
+        raise ValueError("No data available for the selected month.")
+
+    # Create the 'identifier' column
+    df['identifier'] = df['review id'].combine_first(df['cost centre']) if 'review id' in df.columns else df['cost centre']
+
+    # Filter the data based on 'order type'
+    regular_pax = df[df['order type'].isin(['regular', 'regular-pop-up', 'food trial'])]
+    regular_amt = df[df['order type'].isin(['regular', 'smartq-pop-up', 'food trial', 'regular-pop-up', 'tuckshop', 'live'])]
+    event_amt = df[df['order type'].isin(['event', 'event-pop-up', 'adhoc'])]
+    no_of_days = df[(df['buying pax'] > 0) | (df['selling pax'] > 0)]
+
+    # Group the data by 'identifier' and 'month'
+    grouped_data = df.groupby(['identifier', 'month'])
+    regular_pax_grouped = regular_pax.groupby(['identifier', 'month'])
+    regular_amt_grouped = regular_amt.groupby(['identifier', 'month'])
+    event_amt_grouped = event_amt.groupby(['identifier', 'month'])
+    no_of_days_grouped = no_of_days.groupby(['identifier', 'month'])
+
+    # Create the P&L DataFrame
+    pnl_data = pd.DataFrame({
+        'days': no_of_days_grouped['date'].nunique(),
+        'buying pax': regular_pax_grouped['buying pax'].sum(),
+        'selling pax': regular_pax_grouped['selling pax'].sum(),
+        'regular buying amount': regular_amt_grouped['buying amt ai'].sum(),
+        'regular selling amount': regular_amt_grouped['selling amount'].sum(),
+        'event buying amount': event_amt_grouped['buying amt ai'].sum(),
+        'event selling amount': event_amt_grouped['selling amount'].sum(),
+        'penalty on vendor': grouped_data['penalty on vendor'].sum(),
+        'penalty on smartq': grouped_data['penalty on smartq'].sum(),
+        'sams': grouped_data['amount'].sum()
+    }).reset_index()
+
+    return pnl_data
+
 def load_business_logic(df, selected_month):
     try:
-        # Clean up the data by stripping spaces and converting strings to lowercase
-        df = df.applymap(lambda x: x.strip().lower() if isinstance(x, str) else x)
-        df = df[df['month'] == selected_month]
-
-        if df.empty:
-            raise ValueError("No data available for the selected month.")
-
-        # Create the 'identifier' column
-        df['identifier'] = df['review id'].combine_first(df['cost centre']) if 'review id' in df.columns else df['cost centre']
-
-        # Filter the data based on 'order type'
-        regular_pax = df[df['order type'].isin(['regular', 'regular-pop-up', 'food trial'])]
-        regular_amt = df[df['order type'].isin(['regular', 'smartq-pop-up', 'food trial', 'regular-pop-up', 'tuckshop', 'live'])]
-        event_amt = df[df['order type'].isin(['event', 'event-pop-up', 'adhoc'])]
-        no_of_days = df[(df['buying pax'] > 0) | (df['selling pax'] > 0)]
-
-        # Group the data by 'identifier' and 'month'
-        grouped_data = df.groupby(['identifier', 'month'])
-        regular_pax_grouped = regular_pax.groupby(['identifier', 'month'])
-        regular_amt_grouped = regular_amt.groupby(['identifier', 'month'])
-        event_amt_grouped = event_amt.groupby(['identifier', 'month'])
-        no_of_days_grouped = no_of_days.groupby(['identifier', 'month'])
-
-        # Create the P&L DataFrame
-        pnl_data = pd.DataFrame({
-            'days': no_of_days_grouped['date'].nunique(),
-            'buying pax': regular_pax_grouped['buying pax'].sum(),
-            'selling pax': regular_pax_grouped['selling pax'].sum(),
-            'regular buying amount': regular_amt_grouped['buying amt ai'].sum(),
-            'regular selling amount': regular_amt_grouped['selling amount'].sum(),
-            'event buying amount': event_amt_grouped['buying amt ai'].sum(),
-            'event selling amount': event_amt_grouped['selling amount'].sum(),
-            'penalty on vendor': grouped_data['penalty on vendor'].sum(),
-            'penalty on smartq': grouped_data['penalty on smartq'].sum(),
-            'sams': grouped_data['amount'].sum()
-        }).reset_index()
-
-        return format_dataframe(pnl_data)
-
+        return compute_pnl_data(df, selected_month)
     except Exception as e:
         st.error(f"Error loading business logic data: {e}")
         return None
 
-def format_dataframe(df):
-    for column in df.select_dtypes(include=['float', 'int']).columns:
-        df[column] = df[column].map(lambda x: f"{x:.1f}")
-    return df
-
 def load_pnl_data(p_and_l_file_path):
     try:
-        pnl_df = pd.read_excel(p_and_l_file_path, header=0)
-        pnl_df = pnl_df.applymap(lambda x: x.strip().lower() if isinstance(x, str) else x)
-        return pnl_df
+        # Parsed once per process and shared by every module; re-read only when P&L.xlsx or its journal changes
+        return read_pnl_view(p_and_l_file_path)
     except FileNotFoundError:
         st.error("Output file not found. Please check the file path.")
         return None
+    except KeyError as e:
+        # A P&L.xlsx header that does not match the expected columns
+        st.error(f"Error processing data: {e}")
+        return None
 
-def save_updated_data(df, p_and_l_file_path):
+def save_updated_data(pnl_changes, p_and_l_file_path, sheet_name=None, row_hashes=None):
+    # The shared writer serializes P&L writes across modules and processes; wait for our flush to finish.
+    # Returns the cells rejected because another punch changed them since the P&L was loaded, or None on failure.
     try:
-        with lock:
-            df.to_excel(p_and_l_file_path, index=False)
-            if os.path.exists(p_and_l_file_path):
-                os.chmod(p_and_l_file_path, 0o666)
-            else:
-                st.error(f"File not found: {p_and_l_file_path}")
+        with st.spinner("Writing to P&L..."):
+            rejected = write_pnl_changes(p_and_l_file_path, pnl_changes, sheet_name, __name__, row_hashes=row_hashes)
+        if not rejected.empty:
+            keys = pd.MultiIndex.from_frame(rejected[['cost centre', 'month']]).unique()
+            st.warning(f"{len(rejected)} cell(s) were changed by another punch since the P&L was loaded and were left as they are: {format_pnl_keys(keys)}")
+        return rejected
+    except FileNotFoundError:
+        st.error(f"File not found: {p_and_l_file_path}")
     except PermissionError:
         st.error("Permission denied: You don't have the necessary permissions to change the permissions of this file.")
+    except Exception as e:
+        st.error(f"Error saving P&L: {e}")
+    return None
 
 def process_data(pnl_df, pnl_data):
     try:
-        pnl_mapping = {
-            'days': 'days',
-            'buying pax': 'buying pax',
-            'selling pax': 'selling pax',
-            'regular buying amount': 'regular buying',
-            'regular selling amount': 'selling -gmv',
-            'event buying amount': 'event buying',
-            'event selling amount': 'event -gmv',
-            'penalty on vendor': 'penalty on vendor',
-            'penalty on smartq': 'penalty on smartq',
-            'sams': 'sams'
-        }
-
-        # Rename columns according to the mapping
-        pnl_data = pnl_data.rename(columns=pnl_mapping)
-
-        # Merge data
-        pnl_merged_df = pd.merge(pnl_df, pnl_data, left_on=['cost centre', 'month'], right_on=['identifier', 'month'], how='left', suffixes=('', '_new'))
-
-        # Check for unmatched data
-        unmatched = pnl_data[~pnl_data.set_index(['identifier', 'month']).index.isin(pnl_merged_df.set_index(['cost centre', 'month']).index)]
-        if not unmatched.empty:
-            st.error("Could not find a match for cost centre & month.")
+        # Align both sides on (cost centre, month) and write the mapped columns in one assignment
+        pnl_merged_df, pnl_changes, unmatched = apply_pnl_update(pnl_df, pnl_data, PNL_MAPPING)
+        if len(unmatched):
+            st.error(f"Could not find a match for cost centre & month: {format_pnl_keys(unmatched)}")
             return None, None
 
-        # Update the original data with the new values
-        for col in pnl_mapping.values():
-            pnl_merged_df[col] = pnl_merged_df[f"{col}_new"].combine_first(pnl_merged_df[col])
-        pnl_merged_df.drop(columns=[f"{col}_new" for col in pnl_mapping.values()], inplace=True)
-
-        # Identify rows with updated data
-        updated_rows = pnl_merged_df[(pnl_merged_df[list(pnl_mapping.values())] != pnl_df[list(pnl_mapping.values())]).any(axis=1)].copy()
-
-        # Prepare the updated rows DataFrame
-        updated_rows = updated_rows[['cost centre', 'month', 'site name'] + list(pnl_mapping.values())]
-        updated_rows.columns = ['Cost Centre', 'Month', 'Site Name'] + [f"Updated {col.title().replace('_', ' ')}" for col in pnl_mapping.values()]
-        updated_rows.dropna(subset=[f"Updated {col.title().replace('_', ' ')}" for col in pnl_mapping.values()], how='all', inplace=True)
-
-        return pnl_merged_df, updated_rows
+        return pnl_merged_df, pnl_changes
     except Exception as e:
         st.error(f"Error processing data: {e}")
         return None, None
 
-def update_p_and_l(df, selected_month, p_and_l_file_path):
+def update_p_and_l(df, selected_month, p_and_l_file_path, sheet_name=None):
     pnl_data = load_business_logic(df, selected_month)
     if pnl_data is None:
         return
+    # Only keys whose computed rows changed since they were last punched are merged and written
+    try:
+        changed, row_hashes = unpunched_rows(p_and_l_file_path, mapped_pnl_rows(pnl_data, PNL_MAPPING))
+    except KeyError as e:
+        st.error(f"Error processing data: {e}")
+        return
+    if not changed.any():
+        st.success("P&L is already up to date")
+        return
     pnl_df = load_pnl_data(p_and_l_file_path)
     if pnl_df is None:
         return
-    pnl_merged_df, updated_rows = process_data(pnl_df, pnl_data)
-    if pnl_merged_df is not None:
-        save_updated_data(pnl_merged_df, p_and_l_file_path)
+    pnl_merged_df, pnl_changes = process_data(pnl_df, pnl_data[changed])
+    if pnl_merged_df is None:
+        return
+    rejected = save_updated_data(pnl_changes, p_and_l_file_path, sheet_name, row_hashes)
+    if rejected is not None:
         st.success("Successfully Punched P&L")
-        st.dataframe(format_dataframe(updated_rows))
+        report = updated_rows_report(pnl_merged_df, without_cells(pnl_changes, rejected))
+        st.dataframe(report, column_config=number_config(report))
+        export_buttons(report, "updated_rows", "P&L update")
 
-def clear_p_and_l_data(df, selected_month, p_and_l_file_path):
+def clear_p_and_l_data(df, selected_month, p_and_l_file_path, sheet_name=None):
     pnl_data = load_business_logic(df, selected_month)
     if pnl_data is None:
         return
@@ -380,35 +407,21 @@ def clear_p_and_l_data(df, selected_month, p_and_l_file_path):
         return
 
     try:
-        pnl_mapping = {
-            'days': 'days',
-            'buying pax': 'buying pax',
-            'selling pax': 'selling pax',
-            'regular buying amount': 'regular buying',
-            'regular selling amount': 'selling -gmv',
-            'event buying amount': 'event buying',
-            'event selling amount': 'event -gmv',
-            'penalty on vendor': 'penalty on vendor',
-            'penalty on smartq': 'penalty on smartq',
-            'sams': 'sams'
-        }
-
-        # Clear the data by setting the relevant columns to None
-        for identifier_val, month in zip(pnl_data['identifier'], pnl_data['month']):
-            if not ((pnl_df['cost centre'] == identifier_val) & (pnl_df['month'] == month)).any():
-                st.error(f"Could not find a match for cost centre {identifier_val} & month {month}.")
-                return
-            pnl_df.loc[(pnl_df['cost centre'] == identifier_val) & (pnl_df['month'] == month), pnl_mapping.values()] = None
-
-        save_updated_data(pnl_df, p_and_l_file_path)
-        st.write("Data cleared successfully!")
+        # Look up every (cost centre, month) at once and null the mapped columns in one assignment
+        pnl_df, pnl_changes, missing = clear_pnl_keys(pnl_df, pnl_data, PNL_MAPPING)
+        if len(missing):
+            st.error(f"Could not find a match for cost centre & month: {format_pnl_keys(missing)}")
+            return
+
+        if save_updated_data(pnl_changes, p_and_l_file_path, sheet_name) is not None:
+            st.write("Data cleared successfully!")
     except Exception as e:
         st.error(f"Error clearing data: {e}")
 
 
 #-------------------------------------------------------Auto Dump--------------------------------------------------
 
-def dump_data(df_filtered, month, dump_file_path):
+def dump_data(df_filtered, month, dump_file_path, sheet_name=None, replace=False):
     dump_mapping = {
         'date': 'date',
         'month': 'month',
@@ -439,21 +452,19 @@ def dump_data(df_filtered, month, dump_file_path):
     }
     
     try:
-        dump_df = load_dump_data(dump_file_path)
-        if dump_df is None:
+        dump_summary = load_dump_data(dump_file_path)
+        if dump_summary is None:
             return
 
-        if not dump_df.empty:
-            last_row = dump_df.iloc[-1]
-            last_row_df = last_row.to_frame().T
-            last_row_df.insert(0, 'row number', len(dump_df) + 1)
+        if dump_summary['rows']:
+            last_row_df = pd.DataFrame([dump_summary['last row']])
+            last_row_df.insert(0, 'row number', dump_summary['rows'] + 1)
             st.write("Last updated row before current dump:")
             st.dataframe(last_row_df)
 
-        mapped_df = pd.DataFrame()
-        for dump_col, df_col in dump_mapping.items():
-            if df_col in df_filtered.columns and dump_col in dump_df.columns:
-                mapped_df[dump_col] = df_filtered[df_col]
+        mapped_df, coerced = map_dump_rows(df_filtered, dump_mapping)
+        if coerced:
+            st.warning(f"Stored {format_coerced(coerced)} as blanks: they were not numbers or dates.")
 
         if 'selling management' in df_filtered.columns:
             selling_sum = df_filtered['selling management'].sum()
@@ -463,32 +474,39 @@ def dump_data(df_filtered, month, dump_file_path):
                 'order type': ['management fee'],
                 'selling amount': [selling_sum]
             })
-            dump_df = pd.concat([dump_df, new_row], ignore_index=True)
+            new_rows = pd.concat([conform_dump_rows(new_row), mapped_df], ignore_index=True)
+        else:
+            new_rows = mapped_df
 
-        updated_df = pd.concat([dump_df, mapped_df], ignore_index=True)
-        save_updated_dump_data(updated_df, dump_file_path)
-        logging.info("Filtered data appended to the dump file successfully.")
-        st.success("Filtered data appended to the dump file successfully.")
+        skipped = save_updated_dump_data(new_rows, dump_file_path, sheet_name, replace)
+        if skipped is not None:
+            logging.info(f"Filtered data appended to the dump file successfully ({skipped} duplicate row(s) skipped).")
+            st.success("Filtered data appended to the dump file successfully.")
+            if skipped:
+                st.info(f"{skipped} row(s) were already in the dump and were skipped.")
 
     except Exception as e:
         st.error(f"Error dumping data: {e}")
         logging.error(f"Error dumping data: {e}")
 
 def load_dump_data(dump_file_path):
+    # Header, row count and last row only; the dump history itself is never read
     try:
-        dump_df = pd.read_excel(dump_file_path, header=0)
-        dump_df.columns = dump_df.columns.str.lower().str.strip()
-        return dump_df
+        return read_dump_summary(dump_file_path)
     except FileNotFoundError:
         st.write("Output file not found. Please check the file path.")
         return None
 
-def save_updated_dump_data(df, dump_file_path):
+def save_updated_dump_data(new_rows, dump_file_path, sheet_name=None, replace=False):
+    # Appended by the shared writer, so concurrent dumps from other modules are not lost.
+    # Returns how many rows were skipped as already dumped, or None on failure.
     try:
-        df.to_excel(dump_file_path, index=False)
-        if os.path.exists(dump_file_path):
-            os.chmod(dump_file_path, 0o666)
-        else:
-            st.write("File not found:", dump_file_path)
+        with st.spinner("Writing to dump..."):
+            return write_dump_rows(dump_file_path, new_rows, sheet_name, replace)
+    except FileNotFoundError:
+        st.write("File not found:", dump_file_path)
     except PermissionError:
         st.write("Permission denied: You don't have the necessary permissions to change the permissions of this file.")
+    except Exception as e:
+        st.error(f"Error saving dump: {e}")
+    return None
@@ -0,0 +1,49 @@
+import functools
+import operator
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from dump_store import DUMP_SCHEMA, dataset_dir, dump_field, scan_dump
+
+# Aggregations query_dump accepts, named as pyarrow names them
+AGGREGATIONS = ['sum', 'mean', 'count', 'min', 'max']
+# Dump columns that can be grouped on and those that can be aggregated
+GROUP_COLUMNS = [field.name for field in DUMP_SCHEMA if pa.types.is_string(field.type)]
+MEASURE_COLUMNS = [field.name for field in DUMP_SCHEMA if pa.types.is_floating(field.type)]
+
+def dump_condition(months=None, sites=None, equals=None, contains=None, date_from=None, date_to=None):
+    # One filter expression: month and site clauses prune partitions, the rest are pushed into the parquet scan.
+    # equals is {column: [values]}; contains is {column: text}, matched case-insensitively.
+    clauses = []
+    for column, values in (('month', months), ('site name', sites)):
+        if values is not None:
+            clauses.append(ds.field(dump_field(column)).isin(list(values)))
+    for column, values in (equals or {}).items():
+        clauses.append(ds.field(dump_field(column)).isin(list(values)))
+    for column, text in (contains or {}).items():
+        clauses.append(pc.match_substring(ds.field(dump_field(column)), text, ignore_case=True))
+    if date_from is not None:
+        clauses.append(ds.field('date') >= pa.scalar(pd.Timestamp(date_from), type=pa.timestamp('ns')))
+    if date_to is not None:
+        clauses.append(ds.field('date') <= pa.scalar(pd.Timestamp(date_to), type=pa.timestamp('ns')))
+    return functools.reduce(operator.and_, clauses) if clauses else None
+
+def query_dump(dump_file_path, group_by, measures, aggregation='sum', **filters):
+    # Grouped aggregates over the dump history, for example total selling amount by vendor for Airtel sites:
+    #   query_dump(DUMP_FILE_PATH, ['vendor'], ['selling amount'], contains={'site name': 'airtel'}, months=[...])
+    # Only the grouped, measured and filtered columns of the matching partitions are read.
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregation}'; use one of {', '.join(AGGREGATIONS)}")
+    result_columns = list(group_by) + [f"{aggregation} of {measure}" for measure in measures]
+    if not os.path.isdir(dataset_dir(dump_file_path)):
+        return pd.DataFrame(columns=result_columns)
+    table = scan_dump(dump_file_path, list(dict.fromkeys(list(group_by) + list(measures))), dump_condition(**filters))
+    result = table.group_by(list(group_by)).aggregate([(measure, aggregation) for measure in measures])
+    # pyarrow puts the aggregates first and names them "<column>_<aggregation>"
+    result = result.to_pandas().rename(columns={f"{measure}_{aggregation}": f"{aggregation} of {measure}" for measure in measures})
+    result = result[result_columns]
+    return result.sort_values(list(group_by), ignore_index=True) if group_by else result
@@ -0,0 +1,308 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+from pnl_journal import decode_value, encode_value
+
+# Dump columns in the legacy Dump.xlsx order, with the type each is stored as
+DUMP_SCHEMA = pa.schema([
+    ('date', pa.timestamp('ns')),
+    ('month', pa.string()),
+    ('day', pa.string()),
+    ('cost centre', pa.string()),
+    ('site name', pa.string()),
+    ('vendor code', pa.string()),
+    ('vendor', pa.string()),
+    ('session', pa.string()),
+    ('meal type', pa.string()),
+    ('order type', pa.string()),
+    ('client mg/pre order', pa.float64()),
+    ('ordered pax/vendor mg', pa.float64()),
+    ('actual consumption', pa.float64()),
+    ('buying pax', pa.float64()),
+    ('buying price', pa.float64()),
+    ('buying price ai', pa.float64()),
+    ('buying transportation', pa.float64()),
+    ('buying amt ai', pa.float64()),
+    ('selling pax', pa.float64()),
+    ('selling price', pa.float64()),
+    ('selling transportation', pa.float64()),
+    ('selling amount', pa.float64()),
+    ('penalty on vendor', pa.float64()),
+    ('penalty on smartq', pa.float64()),
+    ('cash recived', pa.float64()),
+    ('commission', pa.float64()),
+    ('amount', pa.float64()),
+])
+# pandas dtypes of conformed dump rows
+DUMP_DTYPES = [np.dtype(field.type.to_pandas_dtype()) for field in DUMP_SCHEMA]
+# Directory level -> dump column it partitions on; these columns live in the path, not in the files
+PARTITION_COLUMNS = {'month': 'month', 'site': 'site name'}
+FILE_SCHEMA = pa.schema([field for field in DUMP_SCHEMA if field.name not in PARTITION_COLUMNS.values()])
+PARTITION_SCHEMA = pa.schema([(level, pa.string()) for level in PARTITION_COLUMNS])
+# Directory value hive partitioning reads back as a blank
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+def dataset_dir(dump_file_path):
+    # month=<month>/site=<site name>/<part>.parquet; Dump.xlsx keeps the history until it is imported
+    return f"{os.path.splitext(dump_file_path)[0]} dataset"
+
+def legacy_parts_dir(dump_file_path):
+    # Monthly xlsx part files written before the dump moved to the dataset
+    return f"{os.path.splitext(dump_file_path)[0]} parts"
+
+def manifest_path(dump_file_path):
+    # Row count and last row of the whole dump, so the preview never reads the history
+    return f"{dump_file_path}.manifest.json"
+
+def partition_value(value):
+    return NULL_PARTITION if pd.isna(value) else quote(str(value), safe='')
+
+def partition_dir(dump_file_path, month, site):
+    return os.path.join(dataset_dir(dump_file_path), f"month={partition_value(month)}", f"site={partition_value(site)}")
+
+def cast_dump_column(values, dtype):
+    # Cast one dump column to its schema type; returns (column, how many values did not fit and became nulls).
+    # Blanks become nulls too, but are not counted.
+    if pa.types.is_string(dtype):
+        return values.map(lambda value: None if pd.isna(value) else str(value)).astype(object), 0
+    blank = values.isna() | values.map(lambda value: isinstance(value, str) and not value.strip())
+    cast = pd.to_datetime(values.mask(blank), errors='coerce') if pa.types.is_timestamp(dtype) else pd.to_numeric(values.mask(blank), errors='coerce')
+    coerced = int((cast.isna() & ~blank).sum())
+    return (cast.astype('float64') if pa.types.is_floating(dtype) else cast), coerced
+
+def map_dump_rows(df, dump_mapping):
+    # MIS rows in the dump layout in one pass: pick the mapped MIS columns, name them after the dump, reindex and cast.
+    # The layout comes from DUMP_SCHEMA, so the dump itself is never read to build its rows.
+    # Returns (rows, {dump column: values stored as nulls because they did not fit}).
+    mapped = {dump_col: df_col for dump_col, df_col in dump_mapping.items() if df_col in df.columns}
+    return coerce_dump_rows(df[list(mapped.values())].set_axis(list(mapped), axis=1))
+
+def coerce_dump_rows(rows):
+    # Dump rows with exactly the DUMP_SCHEMA columns, in its order and types, and the count of values per column
+    # that did not fit their type and were stored as nulls instead of failing the whole dump
+    if list(rows.columns) == DUMP_SCHEMA.names and list(rows.dtypes) == DUMP_DTYPES:
+        return rows, {}
+    rows = rows.reindex(columns=DUMP_SCHEMA.names)
+    columns, coerced = {}, {}
+    for field in DUMP_SCHEMA:
+        columns[field.name], count = cast_dump_column(rows[field.name], field.type)
+        if count:
+            coerced[field.name] = count
+    return pd.DataFrame(columns, index=rows.index), coerced
+
+def conform_dump_rows(rows):
+    # coerce_dump_rows for rows whose caller has nobody to report to; coerced values are logged
+    rows, coerced = coerce_dump_rows(rows)
+    if coerced:
+        logging.warning(f"Stored {format_coerced(coerced)} as blanks in the dump.")
+    return rows
+
+def format_coerced(coerced):
+    return ", ".join(f"{count} value(s) of '{column}'" for column, count in coerced.items())
+
+def dump_dataset(dump_file_path):
+    return ds.dataset(dataset_dir(dump_file_path), schema=pa.unify_schemas([FILE_SCHEMA, PARTITION_SCHEMA]),
+                      format='parquet', partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'))
+
+def month_order(month):
+    # Sort key of a month label such as "jan'24": by calendar month, labels that are not months last by text
+    parsed = pd.to_datetime(month.strip().title(), format="%b'%y", errors='coerce')
+    return (pd.isna(parsed), parsed if not pd.isna(parsed) else pd.Timestamp.min, month)
+
+def dump_months(dump_file_path):
+    # Months present in the dataset, read from the directory names alone
+    if not os.path.isdir(dataset_dir(dump_file_path)):
+        return []
+    names = [name[len('month='):] for name in os.listdir(dataset_dir(dump_file_path)) if name.startswith('month=')]
+    return sorted((unquote(name) for name in names if name != NULL_PARTITION), key=month_order)
+
+def dump_field(column):
+    # Dataset field holding a dump column; partition columns are the directory levels
+    levels = {column: level for level, column in PARTITION_COLUMNS.items()}
+    return levels.get(column, column)
+
+def scan_dump(dump_file_path, columns, condition=None):
+    # Only the partitions condition can match and only the given columns are read
+    table = dump_dataset(dump_file_path).to_table(columns=[dump_field(col) for col in columns], filter=condition)
+    return table.rename_columns(columns)
+
+def read_dump(dump_file_path, months=None, sites=None, columns=None):
+    # Dump rows of the given months and sites; only matching partitions and the requested columns are read
+    columns = columns or DUMP_SCHEMA.names
+    if not os.path.isdir(dataset_dir(dump_file_path)):
+        return pd.DataFrame(columns=columns)
+    condition = None
+    for column, values in (('month', months), ('site name', sites)):
+        if values is not None:
+            clause = ds.field(dump_field(column)).isin(list(values))
+            condition = clause if condition is None else condition & clause
+    return scan_dump(dump_file_path, columns, condition).to_pandas()
+
+def export_dump_excel(dump_file_path, months, output):
+    # Legacy Dump.xlsx layout for the given months, written to a path or file object
+    dump_df = read_dump(dump_file_path, months=months)
+    dump_df.to_excel(output, index=False)
+    return len(dump_df)
+
+def read_sheet_summary(path):
+    # Data row count and last data row of an xlsx, streamed once without building a frame
+    workbook = load_workbook(path, read_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(col).lower().strip() if col is not None else None for col in next(rows, ())]
+        count, last_row = 0, None
+        for row in rows:
+            if any(value is not None for value in row):
+                count, last_row = count + 1, row
+    finally:
+        workbook.close()
+    if last_row is None:
+        return 0, None
+    return count, {col: value for col, value in zip(header, last_row) if col in DUMP_SCHEMA.names}
+
+def legacy_workbooks(dump_file_path):
+    # Dump.xlsx and any xlsx part files, oldest first
+    paths = [dump_file_path] if os.path.exists(dump_file_path) else []
+    if os.path.isdir(legacy_parts_dir(dump_file_path)):
+        parts = [os.path.join(legacy_parts_dir(dump_file_path), name) for name in os.listdir(legacy_parts_dir(dump_file_path)) if name.endswith('.xlsx')]
+        paths += sorted(parts, key=os.path.getmtime)
+    return paths
+
+def build_dump_summary(dump_file_path):
+    # Only needed until the first append writes the manifest
+    rows, last_row = 0, None
+    for path in legacy_workbooks(dump_file_path):
+        workbook_rows, workbook_last_row = read_sheet_summary(path)
+        rows += workbook_rows
+        last_row = workbook_last_row or last_row
+    if os.path.isdir(dataset_dir(dump_file_path)):
+        rows += dump_dataset(dump_file_path).count_rows()
+    return {'columns': DUMP_SCHEMA.names, 'rows': rows, 'last row': last_row}
+
+def read_dump_summary(dump_file_path):
+    # {'columns': dump columns, 'rows': data row count, 'last row': {column: value} or None}
+    if not os.path.isdir(os.path.dirname(dump_file_path) or '.'):
+        raise FileNotFoundError(dump_file_path)
+    try:
+        with open(manifest_path(dump_file_path), encoding='utf-8') as manifest:
+            summary = json.load(manifest, object_hook=decode_value)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return build_dump_summary(dump_file_path)
+    summary['columns'] = DUMP_SCHEMA.names
+    return summary
+
+def write_dump_summary(dump_file_path, summary):
+    temp_path = f"{manifest_path(dump_file_path)}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as manifest:
+        json.dump(summary, manifest, default=encode_value)
+    os.replace(temp_path, manifest_path(dump_file_path))
+
+def dump_row_hashes(rows, sheet=None):
+    # One hash per row over its dump columns, sheet and month. Identical rows within one dump are told apart
+    # by their occurrence, so legitimate repeats in an MIS survive while a second dump of it is skipped.
+    base = pd.util.hash_pandas_object(rows[DUMP_SCHEMA.names].assign(sheet=sheet), index=False)
+    occurrence = base.groupby(base).cumcount()
+    return pd.util.hash_pandas_object(pd.DataFrame({'row': base, 'occurrence': occurrence}), index=False).to_numpy()
+
+def row_hashes_path(directory):
+    # Skipped by dataset discovery like every name starting with '_'
+    return os.path.join(directory, '_row_hashes.npy')
+
+def read_row_hashes(directory):
+    try:
+        return pd.Index(np.load(row_hashes_path(directory)))
+    except FileNotFoundError:
+        return pd.Index(np.array([], dtype='uint64'))
+
+def write_partition_rows(directory, rows, known_hashes):
+    # Add one parquet file with rows to a partition and extend its row-hash index
+    os.makedirs(directory, exist_ok=True)
+    table = pa.Table.from_pandas(rows[FILE_SCHEMA.names], schema=FILE_SCHEMA, preserve_index=False)
+    pq.write_table(table, os.path.join(directory, f"{uuid.uuid4().hex}.parquet"))
+    temp_path = os.path.join(directory, '_row_hashes.tmp')
+    with open(temp_path, 'wb') as hashes_file:
+        np.save(hashes_file, np.concatenate([known_hashes.to_numpy(dtype='uint64'), rows['row hash'].to_numpy(dtype='uint64')]))
+    os.replace(temp_path, row_hashes_path(directory))
+
+def partition_row_count(directory):
+    if not os.path.isdir(directory):
+        return 0
+    return sum(pq.ParquetFile(os.path.join(directory, name)).metadata.num_rows for name in os.listdir(directory) if name.endswith('.parquet'))
+
+def partitions(rows):
+    return rows.groupby(['month', 'site name'], sort=False, dropna=False)
+
+def append_dump_rows(dump_file_path, rows):
+    # rows are conformed to DUMP_SCHEMA and carry 'row hash', 'legacy hash' and 'dump id'. Rows whose row hash or
+    # legacy hash is already in their partition's hash index are skipped. Returns {dump id: rows skipped}.
+    # Must run under the dump file lock.
+    summary = read_dump_summary(dump_file_path)
+    skipped = {}
+    for dump_id, dump_rows in rows.groupby('dump id', sort=False):
+        written = []
+        for (month, site), group in partitions(dump_rows):
+            directory = partition_dir(dump_file_path, month, site)
+            known_hashes = read_row_hashes(directory)
+            new_rows = group[~group['row hash'].isin(known_hashes) & ~group['legacy hash'].isin(known_hashes)]
+            if not new_rows.empty:
+                write_partition_rows(directory, new_rows, known_hashes)
+                written.append(new_rows)
+        written_rows = sum(len(new_rows) for new_rows in written)
+        skipped[dump_id] = len(dump_rows) - written_rows
+        if written:
+            summary['rows'] += written_rows
+            summary['last row'] = written[-1][DUMP_SCHEMA.names].iloc[-1].to_dict()
+    write_dump_summary(dump_file_path, summary)
+    return skipped
+
+def replace_dump_partitions(dump_file_path, rows):
+    # Swap out every (month, site name) partition the rows belong to for exactly these rows.
+    # Returns {dump id: 0} like append_dump_rows. Must run under the dump file lock.
+    summary = read_dump_summary(dump_file_path)
+    for dump_id, dump_rows in rows.groupby('dump id', sort=False):
+        for (month, site), group in partitions(dump_rows):
+            directory = partition_dir(dump_file_path, month, site)
+            parent, name = os.path.split(directory)
+            # Staged beside the partition under names dataset discovery skips, then swapped in with renames
+            staging, retired = os.path.join(parent, f"_{name}.new"), os.path.join(parent, f"_{name}.old")
+            shutil.rmtree(staging, ignore_errors=True)
+            write_partition_rows(staging, group, read_row_hashes(staging))
+            summary['rows'] += len(group) - partition_row_count(directory)
+            if os.path.isdir(directory):
+                os.replace(directory, retired)
+            os.replace(staging, directory)
+            shutil.rmtree(retired, ignore_errors=True)
+        summary['last row'] = dump_rows[DUMP_SCHEMA.names].iloc[-1].to_dict()
+    write_dump_summary(dump_file_path, summary)
+    return {dump_id: 0 for dump_id in rows['dump id'].unique()}
+
+def import_legacy_dump(dump_file_path):
+    # One-off move of Dump.xlsx and the xlsx part files into the dataset; the workbooks are renamed, not deleted.
+    # Returns (rows imported, {dump column: values stored as nulls}). Must run under the dump file lock.
+    imported, coerced = 0, {}
+    for path in legacy_workbooks(dump_file_path):
+        legacy_df = pd.read_excel(path, header=0)
+        legacy_df.columns = legacy_df.columns.str.lower().str.strip()
+        rows, workbook_coerced = coerce_dump_rows(legacy_df)
+        for column, count in workbook_coerced.items():
+            coerced[column] = coerced.get(column, 0) + count
+        # Dump.xlsx does not say which sheet a row came from, so its rows are hashed without one;
+        # a later dump of the same sheet matches them through its legacy hash
+        rows['row hash'] = dump_row_hashes(rows)
+        for (month, site), group in partitions(rows):
+            directory = partition_dir(dump_file_path, month, site)
+            write_partition_rows(directory, group, read_row_hashes(directory))
+        os.replace(path, f"{path}.imported")
+        imported += len(legacy_df)
+    return imported, coerced
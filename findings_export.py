@@ -0,0 +1,94 @@
+import hashlib
+import io
+import threading
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.comments import Comment
+from openpyxl.styles import PatternFill
+
+from sized_cache import SizedCache
+
+# Rows converted to Python values at a time; the writers never hold more than one chunk of cells as objects
+EXPORT_CHUNK_ROWS = 10000
+# Bytes of built exports kept for repeated downloads; the least recently downloaded go first
+MAX_EXPORT_BYTES = 256 * 1024 * 1024
+
+# Uploaded MIS sheets are read with header=1, so their column names are on the second row
+MIS_HEADER_ROW = 2
+# One fill shared by every highlighted cell, so the workbook gets a single new style
+MISMATCH_FILL = PatternFill(fill_type='solid', start_color='FFFFC7CE', end_color='FFFFC7CE')
+
+# (content hash, columns, format) -> file contents
+_exports = SizedCache(MAX_EXPORT_BYTES)
+_lock = threading.Lock()
+
+def excel_value(value):
+    # Cells openpyxl can write: blanks as None, numpy scalars and timestamps as their Python equivalents
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def write_xlsx(df, output):
+    # Write-only workbook: rows are streamed to the sheet instead of being kept as a grid of cells
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Findings")
+    sheet.append([str(col) for col in df.columns])
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        for row in df.iloc[start:start + EXPORT_CHUNK_ROWS].itertuples(index=False):
+            sheet.append([excel_value(value) for value in row])
+    workbook.save(output)
+
+def write_csv(df, output):
+    df.to_csv(output, index=False, chunksize=EXPORT_CHUNK_ROWS)
+
+EXPORT_WRITERS = {
+    'xlsx': write_xlsx,
+    'csv': write_csv,
+}
+
+def export_key(df, file_format):
+    # Row hashes digested in order, so a sorted or filtered view never shares a key with the frame it came from
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest(), tuple(map(str, df.columns)), file_format
+
+def export_bytes(df, file_format):
+    # File contents of df as xlsx or csv, built once per content and format and then served from the cache
+    key = export_key(df, file_format)
+    with _lock:
+        data = _exports.get(key)
+    if data is not None:
+        return data
+
+    output = io.BytesIO()
+    EXPORT_WRITERS[file_format](df, output)
+    data = output.getvalue()
+    with _lock:
+        _exports.add(key, data, len(data))
+        _exports.evict()
+    return data
+
+def expected_note(values):
+    # Comment text of one cell; rounded like the findings grid shows it
+    return "\n".join(f"Expected: {round(value, 2) if isinstance(value, (float, np.floating)) else value}" for value in values)
+
+def annotate_mis(workbook_file, sheet_name, mismatches, output):
+    # Copy of the uploaded workbook with every mismatched cell of sheet_name highlighted and commented with its expected value.
+    # mismatches has the findings' 'Row' (worksheet row), 'Column' and 'Expected'; returns how many cells were annotated.
+    workbook = load_workbook(workbook_file)
+    sheet = workbook[sheet_name]
+    columns = {str(cell.value).lower().strip(): cell.column for cell in sheet[MIS_HEADER_ROW] if cell.value is not None}
+    mismatches = mismatches[mismatches['Column'].isin(columns.keys())]
+    # All notes are built in one grouped pass; the loop below only assigns them
+    notes = mismatches.groupby(['Row', 'Column'], sort=False)['Expected'].agg(expected_note)
+    for (row_number, column), note in notes.items():
+        cell = sheet.cell(row=int(row_number), column=columns[column])
+        cell.fill = MISMATCH_FILL
+        cell.comment = Comment(note, "MIS Reviewer")
+    workbook.save(output)
+    return len(notes)
@@ -0,0 +1,98 @@
+import math
+
+import pandas as pd
+import streamlit as st
+
+from findings_export import export_bytes
+
+# Rows sent to the browser per page of a findings table
+PAGE_SIZES = [25, 50, 100, 500]
+# Mismatches are summarized per (column, session, order type, vendor) before any of their rows is shown
+MISMATCH_GROUPS = ['Column', 'Session', 'Order Type', 'Vendor']
+# Display format of numeric columns; applied when rendering, the data itself stays numeric
+NUMBER_FORMAT = "%.1f"
+
+def number_columns(df):
+    return df.select_dtypes(include=['float', 'int']).columns
+
+def number_config(df):
+    # column_config for st.dataframe showing every numeric column to one decimal place
+    return {column: st.column_config.NumberColumn(format=NUMBER_FORMAT) for column in number_columns(df)}
+
+def styled_numbers(df):
+    # Styler for st.table showing every numeric column to one decimal place, without copying the frame
+    return df.style.format(lambda value: NUMBER_FORMAT % value, subset=list(number_columns(df)))
+
+def export_buttons(df, key, file_name):
+    # xlsx and CSV downloads of df; the file is built only when a button is clicked, and clicking does not rerun the page
+    xlsx_col, csv_col, _ = st.columns([1, 1, 6])
+    xlsx_col.download_button("Download xlsx", lambda: export_bytes(df, 'xlsx'), file_name=f"{file_name}.xlsx",
+                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key=f"{key}_xlsx", on_click="ignore")
+    csv_col.download_button("Download CSV", lambda: export_bytes(df, 'csv'), file_name=f"{file_name}.csv",
+                            mime="text/csv", key=f"{key}_csv", on_click="ignore")
+
+def filter_rows(df, text):
+    # Rows with text in any column, matched column by column without building a string copy of the frame
+    mask = pd.Series(False, index=df.index)
+    for column in df.columns:
+        mask |= df[column].astype(str).str.contains(text, case=False, regex=False, na=False)
+    return df[mask]
+
+def sort_rows(df, column, ascending):
+    # Object columns can mix numbers with text such as the pivot's 'N/A', which sort_values cannot compare;
+    # their numbers sort first by value, the rest after them as text
+    if df[column].dtype != object:
+        return df.sort_values(column, ascending=ascending, kind='stable')
+    numbers = pd.to_numeric(df[column], errors='coerce')
+    sort_keys = pd.DataFrame({'number': numbers.to_numpy(), 'text': df[column].where(numbers.isna(), '').astype(str).to_numpy()})
+    return df.iloc[sort_keys.sort_values(['number', 'text'], ascending=ascending, kind='stable', na_position='last').index]
+
+def show_findings(df, key):
+    # Findings grid paged, sorted and filtered on the server, so only the visible page is sent to the browser
+    st.caption(f"{len(df)} row(s)")
+    if len(df) <= PAGE_SIZES[0]:
+        st.dataframe(df, column_config=number_config(df))
+        export_buttons(df, key, key)
+        return
+
+    filter_col, sort_col, order_col, size_col, page_col = st.columns([3, 2, 1, 1, 1])
+    text = filter_col.text_input("Filter", key=f"{key}_filter", placeholder="Contains...")
+    sort_by = sort_col.selectbox("Sort by", [None] + list(df.columns), key=f"{key}_sort", format_func=lambda col: "(unsorted)" if col is None else str(col))
+    ascending = order_col.selectbox("Order", ["Ascending", "Descending"], key=f"{key}_order") == "Ascending"
+    page_size = size_col.selectbox("Rows", PAGE_SIZES, key=f"{key}_size")
+
+    view = filter_rows(df, text) if text else df
+    if sort_by is not None:
+        view = sort_rows(view, sort_by, ascending)
+    pages = max(1, math.ceil(len(view) / page_size))
+    # A filter or a bigger page can leave fewer pages than the one last shown
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = 1
+    page = page_col.number_input("Page", min_value=1, max_value=pages, key=f"{key}_page")
+
+    start = (page - 1) * page_size
+    st.dataframe(view.iloc[start:start + page_size], column_config=number_config(df))
+    filtered = f" (filtered from {len(df)})" if text else ""
+    st.caption(f"Rows {min(start + 1, len(view))}-{min(start + page_size, len(view))} of {len(view)}{filtered}, page {page} of {pages}")
+    # Every row of the filtered and sorted view, not just this page
+    export_buttons(view, key, key)
+
+def show_finding_groups(df, group_columns, key):
+    # Row counts per group first, from one grouped count; a group's rows are only rendered once it is selected,
+    # so a systemic error repeated on every row shows up as a single large group
+    if len(df) <= PAGE_SIZES[0]:
+        show_findings(df, key)
+        return
+    grouped = df.groupby([col for col in group_columns if col in df.columns], dropna=False, sort=False)
+    group_numbers = grouped.ngroup()
+    # Indexed by group number, largest group first
+    counts = grouped.size().rename('Rows').reset_index().sort_values('Rows', ascending=False, kind='stable')
+    st.caption(f"{len(df)} row(s) in {len(counts)} group(s); select a group to see its rows")
+    # A selection is kept per widget key, so the key carries the groups' content: other findings start unselected
+    counts_hash = int(pd.util.hash_pandas_object(counts).sum())
+    selection = st.dataframe(counts, key=f"{key}_groups_{counts_hash:016x}", on_select="rerun", selection_mode="single-row", hide_index=True)
+    export_buttons(df, f"{key}_all", key)
+    selected = [position for position in selection.selection.rows if position < len(counts)]
+    if selected:
+        group_number = counts.index[selected[0]]
+        show_findings(df[(group_numbers == group_number).to_numpy()], f"{key}_rows")
@@ -2,6 +2,18 @@ import pandas as pd
 import logging
 import streamlit as st
 import importlib
+import importlib.util
+from functools import lru_cache
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dump_store import dump_months, export_dump_excel, format_coerced, import_legacy_dump, legacy_workbooks
+from findings_export import annotate_mis
+from pnl_journal import punch_history, read_pnl_view, undo_changes, unpunched_rows
+from pnl_store import PNL_KEY_COLUMNS, apply_pnl_update, format_pnl_keys, mapped_pnl_rows, pnl_index
+from result_cache import cached_call, cached_result, store_result
+from workbook_cache import hold, load_sheet, workbook_hash, workbook_sheet_names
+from write_coordinator import FileLock, watch_journal, write_pnl_changes, write_pnl_punches
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -10,6 +22,127 @@ logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 P_AND_L_FILE_PATH = r"C:\Users\Darshan.Pawar\OneDrive - CPGPLC\Auto P&L\P&L.xlsx"
 DUMP_FILE_PATH = r"C:\Users\Darshan.Pawar\OneDrive - CPGPLC\Auto P&L\Dump.xlsx"
 
+# Sheets whose business logic a bulk punch computes at the same time
+BULK_PUNCH_WORKERS = 4
+# Checks of one sheet run at the same time
+VALIDATION_WORKERS = 4
+
+# Business logic module -> sheets it applies to
+BUSINESS_LOGIC_SHEETS = {
+
+    "business_logic_1": ["Gojek_NCR"], #gojek is ncr
+    "business_logic_2": ["Odessa","Scaler-Prequin","Vector","Quzizz","Ather Mumbai","Groww Mumbai.","MPL-Delhi",
+                         "Tadano"],
+    "business_logic_3": ["Synergy",],
+    "business_logic_4": ["Medtrix","MG Eli Lilly","Tekion.","Awfis","Amadeus","Ather - Main Meal"],
+    "business_logic_5": ["Microchip Main Meal","DTCC Company Paid"],
+    "business_logic_6": ["HD Works"],
+    "business_logic_7": ["MPL"],
+    "business_logic_8": ["Tadano Escorts","Dynasty","Citrix Driver's Lunch & Dinner","sharefile"],
+    "business_logic_9": ["Rippling","Tessolve","Plain View","Ajuba","Corning", "O9 Solutions","Pratilipi","SAEL Delhi"],
+    "business_logic_10": ["MPL - Infinity Plates","Groww Koramangala","Groww VTP","Epam"],
+    "business_logic_11": ["Telstra MainMeal(Cash & Carry)"],
+    "business_logic_12": ["Eli Lilly Wallet."], # get this clarified
+    "business_logic_13": ["Schneider Sodexo Card."],
+    "business_logic_14": ["RAKUTEN-2","Clario"],
+    "business_logic_15": ["Waters Main Meal"], # used BL6 and might be same for seminens
+    "business_logic_16": ["Quest Company Paid"],
+    "business_logic_17": ["Waters Tuck Shop"],
+    "business_logic_18": ["H&M"],
+    "business_logic_19": ["Lam Research","PhonePe"],
+    "business_logic_20": ["Micochip Juice Junction"],
+    "business_logic_21": ["Ather BLR"],
+    "business_logic_22": ["Ather Plant 1.","Ather Plant 2."],  
+    "business_logic_23": ["STRIPE MIS","TEA-Breakfast"],
+    "business_logic_24": ["FRUIT N JUICE MIS"],
+    "business_logic_25": ["Siemens","Toasttab","Gartner"],
+    "business_logic_26": ["DTCC Wallet"],
+    "business_logic_27": ["Siemens_Pune"],
+    "business_logic_28": ["CSG-Pune"],
+    "business_logic_29": ["Salesforce"],
+    "business_logic_30": [""],
+    "business_logic_31": [""],
+    "business_logic_32": ["Siemens_NCR"], # NCR
+    "business_logic_33": ["Postman_NCR","Citrix-Tuckshop"],
+    "business_logic_34": ["Sinch"],
+    "business_logic_35": [""],
+    "business_logic_36": ["Stryker"],
+    "business_logic_37": ["EGL"],
+    "business_logic_38": ["Truecaller"],
+    "business_logic_39": ["Sharefile Wallet"],
+    "business_logic_40": ["Gold Hill-Main Meal","Goldhill Juice Junction.","Healthineer International","Priteck - Main meal","Pritech park Juice junction"],
+    "business_logic_41": ["Siemens-BLR","Siemens Juice Counter"],
+    "business_logic_42": ["Heathineer Factory"],
+    "business_logic_43": ["Airtel Center","Airtel  Plot 5","Airtel NOC Non veg","Airtel international"],
+    "business_logic_44": ["Tekion"],
+    "business_logic_45": ["HD Works(HYD)"],
+    "business_logic_46": ["Airtel Noida"],
+    "business_logic_47": ["Airtel NOC"],
+    "business_logic_48": ["Airtel-Jaya"],
+    "business_logic_49": ["MIQ"],
+    "business_logic_50": ["MIQ MRP"],
+    "business_logic_51": ["Telstra New"],
+    "business_logic_52": [""],
+    "business_logic_53": ["Accenture MDC2B","BDC7A Transport Tea","HDC 5A Transport Tea","HDC 1i OLD ","HDC 1i Sky View 10","MIS Transport Tea DDC 4","MIS Transport Tea - DDC 3"],
+    "business_logic_54": ["Gojek"],
+    "business_logic_55": ["Junglee MIS"],
+    "business_logic_56": ["Tonbo"],
+    "business_logic_57": ["Sinch"],
+    "business_logic_58": ["Schneider-2"],
+    "business_logic_59": ["DTCC Wallet"],
+    "business_logic_60": ["Telstra-Tuck Shop"],
+    "business_logic_61": ["Drivers Tea HYD","Drivers Tea Blore","Drivers Tea Chennai","Siemens - Tuckshop","Tadano Escorts"],
+    "business_logic_62": ["LPG"],
+    "business_logic_63": ["ABM -MEAL"],
+    "business_logic_64": ["Junglee_NCR"],
+    "business_logic_65": ["Sharefile consumables"],
+
+
+
+
+
+
+
+
+
+    "event_logic_1": ["Telstra Event.","Events","WF Hyd Events-Reformat","WF Chennai Events-Reformat","WF BLR Events-Reformat"],
+    "event_logic_2": ["Eli Lilly Event"],
+    "event_logic_3": ["Waters Event"],
+    "event_logic_4": ["infosys Event+ Additional Sales","Other Events.","Telstra Event sheet","Grow event","LTIMindTree-event",
+                      "Mumbai Other Events","JUNGLEE GAMES GUR EVENT","Pune Event MIS"],
+    "event_logic_5": ["Other Events"],
+    "event_logic_6": ["Lam Research Event"],
+    "event_logic_7": ["ICON CHN EVENT"],
+    "event_logic_8": ["other Event MIS"],
+    "event_logic_9": ["Amazon  PNQ Events -"],
+    "event_logic_10": ["Pan India Event MIS"],
+    "event_logic_11": ["Telstra Event"],
+    "event_logic_12": ["Airtel Event"],
+    "event_logic_13": ["Icon-event-Bangalore"],
+
+
+    "other_revenues": ["New Other Revenues"],
+    "welfrgo_other_revenues": ["wellsFargo Other Revenues"],
+
+          # Your business logic mapping here...
+}
+
+def find_business_logic_module(selected_sheet):
+    # Name of the business logic module for a sheet, or None when the sheet has none
+    for module_name, sheets in BUSINESS_LOGIC_SHEETS.items():
+        if selected_sheet in sheets:
+            return module_name
+    return None
+
+@lru_cache(maxsize=None)
+def module_exists(module_name):
+    # Many sheets are mapped to modules that are not in the tree yet
+    return importlib.util.find_spec(module_name) is not None
+
+def has_business_logic(sheet):
+    business_logic_module = find_business_logic_module(sheet)
+    return business_logic_module is not None and module_exists(business_logic_module)
+
 def setup_page():
     # Set up the Streamlit page configuration
     st.set_page_config(page_title="Monthly MIS Checker", layout="wide")
@@ -19,12 +152,22 @@ def upload_file():
     # Sidebar file uploader for Excel files
     return st.sidebar.file_uploader('Upload Excel file', type=['xlsx', 'xls'])
 
-def read_excel_file(uploaded_file):
-    # Read the uploaded Excel file
+def session_id():
+    return st.session_state.setdefault('session_id', uuid.uuid4().hex)
+
+def uploaded_workbook_hash(uploaded_file):
+    # Content hash of the upload, computed once per upload: every upload gets a new file_id, even under the same name
+    if st.session_state.get('uploaded_file_id') != uploaded_file.file_id:
+        st.session_state.uploaded_file_id = uploaded_file.file_id
+        st.session_state.uploaded_workbook_hash = workbook_hash(uploaded_file.getvalue())
+    return st.session_state.uploaded_workbook_hash
+
+def read_excel_file(uploaded_file, workbook):
+    # Read the uploaded workbook's sheet names into the process-wide workbook cache; returns its content hash
     try:
-        excel_file = pd.ExcelFile(uploaded_file)
+        workbook_sheet_names(workbook, uploaded_file)
         logging.info("Excel file uploaded successfully.")
-        return excel_file
+        return workbook
     except ValueError as e:
         st.error(f"Error reading the Excel file: {e}")
         logging.error(f"ValueError reading the Excel file: {e}")
@@ -33,10 +176,14 @@ def read_excel_file(uploaded_file):
         logging.error(f"Unexpected error reading the Excel file: {e}")
     return None
 
-def select_sheet(excel_file):
-    # Select a sheet from the uploaded Excel file
-    sheet_names = excel_file.sheet_names
-    return st.sidebar.selectbox('Select a sheet to display', sheet_names)
+def select_sheet(sheet_names):
+    # Select a sheet from the uploaded Excel file; sheets without a business logic module are hidden unless asked for
+    mapped = [sheet for sheet in sheet_names if has_business_logic(sheet)]
+    if not mapped:
+        st.sidebar.info("No sheet of this workbook has a business logic module.")
+    elif st.sidebar.checkbox("Show sheets without business logic"):
+        mapped = sheet_names
+    return st.sidebar.selectbox('Select a sheet to display', mapped or sheet_names)
 
 def read_sheet_to_dataframe(uploaded_file, selected_sheet):
     # Read the selected sheet into a DataFrame
@@ -64,6 +211,14 @@ def preprocess_dataframe(df):
         logging.error(f"Error processing the data: {e}")
     return df
 
+def load_sheet_dataframe(uploaded_file, workbook, sheet):
+    # (preprocessed sheet, sheet hash), parsed once for every session that uploaded the same workbook.
+    # The frame is shared, so callers must not modify it in place.
+    def parse():
+        df = read_sheet_to_dataframe(uploaded_file, sheet)
+        return None if df is None else preprocess_dataframe(df)
+    return load_sheet(workbook, sheet, parse)
+
 def filter_dataframe_by_month(df):
     # Filter the DataFrame by the selected month
     try:
@@ -88,140 +243,256 @@ def filter_dataframe_by_month(df):
         logging.error(f"Unexpected error filtering data by month: {e}")
     return None, None
 
-def apply_business_logic(df_filtered, selected_sheet, month):
-    # Define the business logic mapping
-    business_logic_sheets = {
-
-            "business_logic_1": ["Gojek_NCR"], #gojek is ncr
-            "business_logic_2": ["Odessa","Scaler-Prequin","Vector","Quzizz","Ather Mumbai","Groww Mumbai.","MPL-Delhi",
-                                 "Tadano"],
-            "business_logic_3": ["Synergy",],
-            "business_logic_4": ["Medtrix","MG Eli Lilly","Tekion.","Awfis","Amadeus","Ather - Main Meal"],
-            "business_logic_5": ["Microchip Main Meal","DTCC Company Paid"],
-            "business_logic_6": ["HD Works"],
-            "business_logic_7": ["MPL"],
-            "business_logic_8": ["Tadano Escorts","Dynasty","Citrix Driver's Lunch & Dinner","sharefile"],
-            "business_logic_9": ["Rippling","Tessolve","Plain View","Ajuba","Corning", "O9 Solutions","Pratilipi","SAEL Delhi"],
-            "business_logic_10": ["MPL - Infinity Plates","Groww Koramangala","Groww VTP","Epam"],
-            "business_logic_11": ["Telstra MainMeal(Cash & Carry)"],
-            "business_logic_12": ["Eli Lilly Wallet."], # get this clarified
-            "business_logic_13": ["Schneider Sodexo Card."],
-            "business_logic_14": ["RAKUTEN-2","Clario"],
-            "business_logic_15": ["Waters Main Meal"], # used BL6 and might be same for seminens
-            "business_logic_16": ["Quest Company Paid"],
-            "business_logic_17": ["Waters Tuck Shop"],
-            "business_logic_18": ["H&M"],
-            "business_logic_19": ["Lam Research","PhonePe"],
-            "business_logic_20": ["Micochip Juice Junction"],
-            "business_logic_21": ["Ather BLR"],
-            "business_logic_22": ["Ather Plant 1.","Ather Plant 2."],  
-            "business_logic_23": ["STRIPE MIS","TEA-Breakfast"],
-            "business_logic_24": ["FRUIT N JUICE MIS"],
-            "business_logic_25": ["Siemens","Toasttab","Gartner"],
-            "business_logic_26": ["DTCC Wallet"],
-            "business_logic_27": ["Siemens_Pune"],
-            "business_logic_28": ["CSG-Pune"],
-            "business_logic_29": ["Salesforce"],
-            "business_logic_30": [""],
-            "business_logic_31": [""],
-            "business_logic_32": ["Siemens_NCR"], # NCR
-            "business_logic_33": ["Postman_NCR","Citrix-Tuckshop"],
-            "business_logic_34": ["Sinch"],
-            "business_logic_35": [""],
-            "business_logic_36": ["Stryker"],
-            "business_logic_37": ["EGL"],
-            "business_logic_38": ["Truecaller"],
-            "business_logic_39": ["Sharefile Wallet"],
-            "business_logic_40": ["Gold Hill-Main Meal","Goldhill Juice Junction.","Healthineer International","Priteck - Main meal","Pritech park Juice junction"],
-            "business_logic_41": ["Siemens-BLR","Siemens Juice Counter"],
-            "business_logic_42": ["Heathineer Factory"],
-            "business_logic_43": ["Airtel Center","Airtel  Plot 5","Airtel NOC Non veg","Airtel international"],
-            "business_logic_44": ["Tekion"],
-            "business_logic_45": ["HD Works(HYD)"],
-            "business_logic_46": ["Airtel Noida"],
-            "business_logic_47": ["Airtel NOC"],
-            "business_logic_48": ["Airtel-Jaya"],
-            "business_logic_49": ["MIQ"],
-            "business_logic_50": ["MIQ MRP"],
-            "business_logic_51": ["Telstra New"],
-            "business_logic_52": [""],
-            "business_logic_53": ["Accenture MDC2B","BDC7A Transport Tea","HDC 5A Transport Tea","HDC 1i OLD ","HDC 1i Sky View 10","MIS Transport Tea DDC 4","MIS Transport Tea - DDC 3"],
-            "business_logic_54": ["Gojek"],
-            "business_logic_55": ["Junglee MIS"],
-            "business_logic_56": ["Tonbo"],
-            "business_logic_57": ["Sinch"],
-            "business_logic_58": ["Schneider-2"],
-            "business_logic_59": ["DTCC Wallet"],
-            "business_logic_60": ["Telstra-Tuck Shop"],
-            "business_logic_61": ["Drivers Tea HYD","Drivers Tea Blore","Drivers Tea Chennai","Siemens - Tuckshop","Tadano Escorts"],
-            "business_logic_62": ["LPG"],
-            "business_logic_63": ["ABM -MEAL"],
-            "business_logic_64": ["Junglee_NCR"],
-            "business_logic_65": ["Sharefile consumables"],
-
-
-
-
-
-
-
-
-
-            "event_logic_1": ["Telstra Event.","Events","WF Hyd Events-Reformat","WF Chennai Events-Reformat","WF BLR Events-Reformat"],
-            "event_logic_2": ["Eli Lilly Event"],
-            "event_logic_3": ["Waters Event"],
-            "event_logic_4": ["infosys Event+ Additional Sales","Other Events.","Telstra Event sheet","Grow event","LTIMindTree-event",
-                              "Mumbai Other Events","JUNGLEE GAMES GUR EVENT","Pune Event MIS"],
-            "event_logic_5": ["Other Events"],
-            "event_logic_6": ["Lam Research Event"],
-            "event_logic_7": ["ICON CHN EVENT"],
-            "event_logic_8": ["other Event MIS"],
-            "event_logic_9": ["Amazon  PNQ Events -"],
-            "event_logic_10": ["Pan India Event MIS"],
-            "event_logic_11": ["Telstra Event"],
-            "event_logic_12": ["Airtel Event"],
-            "event_logic_13": ["Icon-event-Bangalore"],
-
-
-            "other_revenues": ["New Other Revenues"],
-            "welfrgo_other_revenues": ["wellsFargo Other Revenues"],
-
-                  # Your business logic mapping here...
-    }
+def undo_last_punch(selected_sheet, month, business_logic_module):
+    # Restore the cells changed by this sheet's last punch from the journaled before-image, without recomputing the MIS
+    try:
+        records, punch = punch_history(P_AND_L_FILE_PATH, selected_sheet, month)
+        if punch is None:
+            st.write("No punch to undo for this sheet and month.")
+            return
+        changes, skipped = undo_changes(records, punch['punch id'])
+        restored = len(changes)
+        if not changes.empty:
+            # Cells punched again while the undo was in flight are left alone like any other later punch
+            rejected = write_pnl_changes(P_AND_L_FILE_PATH, changes, selected_sheet, business_logic_module, undo_of=punch['punch id'])
+            restored -= len(rejected)
+            skipped += len(rejected)
+        st.success(f"Undid the punch of {punch['timestamp']}: restored {restored} cell(s).")
+        if skipped:
+            st.warning(f"{skipped} cell(s) were changed by a later punch and were left as they are.")
+        logging.info(f"Undid punch {punch['punch id']} of '{selected_sheet}' ({restored} cells restored, {skipped} skipped).")
+    except Exception as e:
+        st.error(f"Error undoing punch: {e}")
+        logging.error(f"Error undoing punch: {e}")
+
+def compute_sheet_pnl(business_logic_module, df_filtered, month):
+    # P&L rows of one sheet, renamed to P&L columns and keyed on (cost centre, month); None when there are none
+    # Runs on pool threads, where st.error would be dropped, so the raising variant is used and the error reaches the summary
+    module = importlib.import_module(business_logic_module)
+    pnl_data = module.compute_pnl_data(df_filtered, month)
+    if pnl_data is None or pnl_data.empty:
+        return None
+    return mapped_pnl_rows(pnl_data, module.PNL_MAPPING)
+
+def punch_all_sheets(uploaded_file, workbook, sheets, month):
+    # Punch several sheets with one read of the P&L and one journaled write; returns one summary row per sheet
+    summary = {sheet: {'Sheet': sheet, 'Business Logic': find_business_logic_module(sheet), 'Status': '', 'Rows': 0, 'Cells Updated': 0} for sheet in sheets}
+
+    # The workbook is parsed one sheet at a time; only the business logic runs in parallel
+    inputs = {}
+    for sheet in sheets:
+        if summary[sheet]['Business Logic'] is None:
+            summary[sheet]['Status'] = "No business logic defined"
+            continue
+        df, _ = load_sheet_dataframe(uploaded_file, workbook, sheet)
+        if df is None:
+            summary[sheet]['Status'] = "Could not read the sheet"
+            continue
+        if 'month' not in df.columns:
+            summary[sheet]['Status'] = "The 'month' column is not present"
+            continue
+        inputs[sheet] = df[df['month'] == month]
+
+    with ThreadPoolExecutor(max_workers=BULK_PUNCH_WORKERS) as executor:
+        futures = {sheet: executor.submit(compute_sheet_pnl, summary[sheet]['Business Logic'], df, month) for sheet, df in inputs.items()}
+    frames = {}
+    row_hashes = {}
+    for sheet, future in futures.items():
+        try:
+            pnl_rows = future.result()
+        except Exception as e:
+            summary[sheet]['Status'] = f"Error loading business logic data: {e}"
+            continue
+        if pnl_rows is None:
+            summary[sheet]['Status'] = "No P&L data for this month"
+            continue
+        summary[sheet]['Rows'] = len(pnl_rows)
+        # Rows that hash the same as their last punch are not merged or written again
+        changed, row_hashes[sheet] = unpunched_rows(P_AND_L_FILE_PATH, pnl_rows)
+        if not changed.any():
+            summary[sheet]['Status'] = "Already up to date"
+            continue
+        frames[sheet] = pnl_rows[changed]
+
+    if frames:
+        try:
+            pnl_df = read_pnl_view(P_AND_L_FILE_PATH)
+            combined = pd.concat(frames, names=['sheet'])
+            keys = combined.index.droplevel('sheet')
+
+            # Every key of every sheet is checked in one pass; a sheet with a bad key is left out as a whole
+            problems = {
+                "Could not find a match for cost centre & month": ~keys.isin(pnl_index(pnl_df)),
+                "Cost centre & month punched by more than one row": keys.duplicated(keep=False),
+            }
+            invalid_sheets = set()
+            for problem, mask in problems.items():
+                bad_keys = combined.index[mask]
+                for sheet in bad_keys.get_level_values('sheet').unique():
+                    sheet_keys = bad_keys[bad_keys.get_level_values('sheet') == sheet].droplevel('sheet')
+                    summary[sheet]['Status'] = f"{problem}: {format_pnl_keys(sheet_keys)}"
+                    invalid_sheets.add(sheet)
+            accepted = combined[~combined.index.get_level_values('sheet').isin(invalid_sheets)]
+
+            cells_rejected = 0
+
+            if not accepted.empty:
+                columns = list(accepted.columns)
+                pnl_data = accepted.reset_index('sheet', drop=True).reset_index()
+                _, changes, _ = apply_pnl_update(pnl_df, pnl_data, dict(zip(columns, columns)))
+
+                # Each sheet's cells are journaled as its own punch, so the Undo tab still works per sheet
+                sheet_of_key = pd.Series(accepted.index.get_level_values('sheet'), index=accepted.index.droplevel('sheet'))
+                change_sheets = sheet_of_key.reindex(pd.MultiIndex.from_frame(changes[PNL_KEY_COLUMNS])).to_numpy()
+                punches = [(sheet_changes, sheet, summary[sheet]['Business Logic']) for sheet, sheet_changes in changes.groupby(change_sheets)]
+                accepted_sheets = accepted.index.get_level_values('sheet').unique()
+                rejected_cells = write_pnl_punches(P_AND_L_FILE_PATH, punches, pd.concat([row_hashes[sheet] for sheet in accepted_sheets], ignore_index=True))
+                cells_rejected = len(rejected_cells)
+                for sheet in accepted_sheets:
+                    sheet_rejected = int((rejected_cells['sheet'] == sheet).sum())
+                    summary[sheet]['Cells Updated'] = int((change_sheets == sheet).sum()) - sheet_rejected
+                    summary[sheet]['Status'] = "Punched" if summary[sheet]['Cells Updated'] else "Already up to date"
+                    if sheet_rejected:
+                        summary[sheet]['Status'] += f"; {sheet_rejected} cell(s) changed by another punch since the P&L was read were left as they are"
+            logging.info(f"Bulk punch of {len(sheets)} sheet(s) for '{month}': {len(accepted.index.get_level_values('sheet').unique())} punched, "
+                         f"{len(invalid_sheets)} left out for invalid keys, {cells_rejected} cell(s) rejected.")
+        except FileNotFoundError:
+            st.error(f"File not found: {P_AND_L_FILE_PATH}")
+            logging.error(f"P&L file not found during bulk punch: {P_AND_L_FILE_PATH}")
+        except Exception as e:
+            st.error(f"Error punching the selected sheets: {e}")
+            logging.error(f"Error punching the selected sheets: {e}")
+
+    return pd.DataFrame(summary.values())
+
+def bulk_punch_section(uploaded_file, workbook, sheet_names, month):
+    # Sidebar action punching every selected sheet of the workbook for the selected month
+    sheets = [sheet for sheet in sheet_names if has_business_logic(sheet)]
+    with st.sidebar.expander("Punch all sheets"):
+        selected_sheets = st.multiselect("Sheets to punch", sheets, default=sheets)
+        punch = st.button("Punch selected sheets", disabled=not selected_sheets)
+    if punch:
+        with st.spinner("Punching selected sheets..."):
+            summary = punch_all_sheets(uploaded_file, workbook, selected_sheets, month)
+        st.subheader("Bulk punch summary")
+        st.dataframe(summary, hide_index=True)
+        st.write("---")
+
+def dump_export_section():
+    # Sidebar export of the dump dataset in the legacy Dump.xlsx layout, for one month or several
+    with st.sidebar.expander("Export dump"):
+        try:
+            if legacy_workbooks(DUMP_FILE_PATH) and st.button("Import Dump.xlsx into the dataset"):
+                # One-off; appends from other reviewers wait on the dump lock until it is done
+                with st.spinner("Importing Dump.xlsx..."), FileLock(DUMP_FILE_PATH):
+                    imported, coerced = import_legacy_dump(DUMP_FILE_PATH)
+                st.success(f"Imported {imported} row(s) into the dump dataset.")
+                if coerced:
+                    st.warning(f"Stored {format_coerced(coerced)} as blanks: they were not numbers or dates.")
+                logging.info(f"Imported {imported} legacy dump row(s) into the dataset.")
+            months = dump_months(DUMP_FILE_PATH)
+            selected_months = st.multiselect("Months to export", months)
+            if selected_months and st.button("Build export"):
+                output = io.BytesIO()
+                with st.spinner("Building Dump.xlsx..."):
+                    rows = export_dump_excel(DUMP_FILE_PATH, selected_months, output)
+                st.download_button(f"Download {rows} row(s)", output.getvalue(), file_name=f"Dump {', '.join(selected_months)}.xlsx")
+        except Exception as e:
+            st.error(f"Error exporting the dump: {e}")
+            logging.error(f"Error exporting the dump: {e}")
+
+def run_checks(module, df_filtered):
+    # Every finding gets its place on the page up front and is rendered there as soon as its check finishes,
+    # instead of the whole report waiting for the slowest check. The checks are mostly Python row loops, so the
+    # pool mainly lets a finished check show while the others run; they only truly overlap where pandas releases the GIL.
+    placeholders = {name: st.empty() for name in module.RENDERERS}
+    for name, placeholder in placeholders.items():
+        placeholder.caption(f"Checking {name.replace('_', ' ')}...")
+    findings = {}
+    with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+        futures = {executor.submit(check, df_filtered): name for name, check in module.CHECKS.items()}
+        # Elements are only updated from the script thread; workers just compute
+        for future in as_completed(futures):
+            name = futures[future]
+            findings[name] = future.result()
+            with placeholders[name].container():
+                module.RENDERERS[name](findings[name])
+    return findings
+
+def annotated_mis_button(uploaded_file, selected_sheet, mismatched_data):
+    # Copy of the uploaded workbook with this sheet's mismatched cells highlighted, built only when the button is clicked
+    def build():
+        output = io.BytesIO()
+        annotate_mis(io.BytesIO(uploaded_file.getvalue()), selected_sheet, pd.DataFrame(mismatched_data), output)
+        return output.getvalue()
+    st.download_button(f"Download '{selected_sheet}' with mismatches highlighted", build, file_name=f"{selected_sheet} annotated.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", on_click="ignore")
+
+@st.fragment
+def validation_report(module, df_filtered, sheet_hash, month, uploaded_file, selected_sheet):
+    # Paging, sorting or filtering a findings table reruns only this report, and unchanged checks render from the cache
+    annotate_button = st.empty()
+    findings = cached_result(module, 'validate', sheet_hash, month)
+    if findings is None:
+        findings = run_checks(module, df_filtered)
+        store_result(module, 'validate', sheet_hash, month, findings)
+    else:
+        module.display_dataframes(**findings)
+    # openpyxl can only annotate xlsx uploads
+    if findings.get('mismatched_data') and uploaded_file.name.lower().endswith('.xlsx'):
+        with annotate_button.container():
+            annotated_mis_button(uploaded_file, selected_sheet, findings['mismatched_data'])
+
+@st.fragment
+def pnl_actions(module, business_logic_module, df_filtered, selected_sheet, month):
+    # Punch, Clear and Undo rerun only this panel, not the month filter and validation above it
+    tab1, tab2, tab3 = st.tabs(["Punch P&L", "Clear", "Undo"])
+    st.write("---")
+    with tab1:
+        if st.button("Punch P&L"):
+            module.update_p_and_l(df_filtered, month, P_AND_L_FILE_PATH, sheet_name=selected_sheet)
+    with tab2:
+        if st.button("Clear"):
+            module.clear_p_and_l_data(df_filtered, month, P_AND_L_FILE_PATH, sheet_name=selected_sheet)
+    with tab3:
+        if st.button("Undo last punch"):
+            undo_last_punch(selected_sheet, month, business_logic_module)
+
+@st.fragment
+def dump_section(module, df_filtered, selected_sheet, month):
+    # Create Dump reruns only this section
+    try:
+        replace = st.checkbox("Replace this month for this site", help="Swap out what the dump holds for this month and site instead of adding to it")
+        if st.button("Create Dump"):
+            dump_function = getattr(module, 'dump_data')
+            dump_function(df_filtered, month, DUMP_FILE_PATH, sheet_name=selected_sheet, replace=replace)
+    except Exception as e:
+        st.error(f"Error in dump section: {e}")
+        logging.error(f"Error in dump section: {e}")
+
+def apply_business_logic(df_filtered, selected_sheet, month, sheet_hash, uploaded_file):
 
     # Determine which business logic to apply based on the selected sheet
-    business_logic_module = None
-    for module_name, sheets in business_logic_sheets.items():
-        if selected_sheet in sheets:
-            business_logic_module = module_name
-            break
+    business_logic_module = find_business_logic_module(selected_sheet)
 
     # Apply the business logic if found
     if business_logic_module:
         try:
             module = importlib.import_module(business_logic_module)
-            business_logic_function = getattr(module, business_logic_module)
-            business_logic_function(df_filtered)
+            validation_report(module, df_filtered, sheet_hash, month, uploaded_file, selected_sheet)
             logging.info(f"Business logic '{business_logic_module}' applied successfully.")
 
-            pnl_data = module.load_business_logic(df_filtered, month)
+            pnl_data = cached_call(module, 'load_business_logic', sheet_hash, month, df_filtered, month)
             if pnl_data is not None:
                 #st.write("\nP&L Data:\n")
                 #st.table(pnl_data)
-
-                tab1, tab2 = st.tabs(["Punch P&L", "Clear"])
-                st.write("---")
-                with tab1:
-                    if st.button("Punch P&L"):
-                        module.update_p_and_l(df_filtered, month, P_AND_L_FILE_PATH)
-                with tab2:
-                    if st.button("Clear"):
-                        module.clear_p_and_l_data(df_filtered, month, P_AND_L_FILE_PATH)
+                pnl_actions(module, business_logic_module, df_filtered, selected_sheet, month)
             else:
                 st.write("No P&L data to display.")
         except ModuleNotFoundError:
             st.error(f"Business logic module '{business_logic_module}' not found.")
             logging.error(f"Business logic module '{business_logic_module}' not found.")
+            return
         except AttributeError:
             st.error(f"Function '{business_logic_module}' not found in the module.")
             logging.error(f"Function '{business_logic_module}' not found in the module.")
@@ -230,13 +501,7 @@ def apply_business_logic(df_filtered, selected_sheet, month):
             logging.error(f"Error applying business logic: {e}")
 
         # Handle the dump section
-        try:
-            if st.button("Create Dump"):
-                dump_function = getattr(module, 'dump_data')
-                dump_function(df_filtered, month, DUMP_FILE_PATH)
-        except Exception as e:
-            st.error(f"Error in dump section: {e}")
-            logging.error(f"Error in dump section: {e}")
+        dump_section(module, df_filtered, selected_sheet, month)
 
     else:
         st.write("No business logic defined for this sheet.")
@@ -244,32 +509,29 @@ def apply_business_logic(df_filtered, selected_sheet, month):
 
 def main():
     setup_page()
+    watch_journal(P_AND_L_FILE_PATH)
     uploaded_file = upload_file()
+    dump_export_section()
 
     if uploaded_file:
-        # Check if a new file is uploaded and clear previous session state if true
-        if 'uploaded_file_name' not in st.session_state or st.session_state.uploaded_file_name != uploaded_file.name:
-            st.session_state.uploaded_file_name = uploaded_file.name
-            st.session_state.excel_file = None
-            st.session_state.df = None
-            st.session_state.selected_sheet = None
-
-        # Read and process the uploaded file if it's not already in session state
-        if 'excel_file' not in st.session_state or st.session_state.excel_file is None:
-            st.session_state.excel_file = read_excel_file(uploaded_file)
-        if st.session_state.excel_file:
-            selected_sheet = select_sheet(st.session_state.excel_file)
-            # Check if the sheet is already loaded, if not, load and preprocess it
-            if 'df' not in st.session_state or st.session_state.selected_sheet != selected_sheet:
-                st.session_state.selected_sheet = selected_sheet
-                st.session_state.df = read_sheet_to_dataframe(uploaded_file, selected_sheet)
-                if st.session_state.df is not None:
-                    st.session_state.df = preprocess_dataframe(st.session_state.df)
-            if st.session_state.df is not None:
+        # Only the workbook's content hash is kept per session; its sheet names and parsed sheets are shared.
+        # A corrected file re-uploaded under the same name has another hash, so it is never served the old sheets.
+        workbook = uploaded_workbook_hash(uploaded_file)
+        if st.session_state.get('workbook') != workbook:
+            st.session_state.workbook = read_excel_file(uploaded_file, workbook)
+        if st.session_state.workbook:
+            workbook = st.session_state.workbook
+            # Renewed on every run, so the hold lapses once the session stops running
+            hold(session_id(), workbook)
+            sheet_names = workbook_sheet_names(workbook, uploaded_file)
+            selected_sheet = select_sheet(sheet_names)
+            df, sheet_hash = load_sheet_dataframe(uploaded_file, workbook, selected_sheet)
+            if df is not None:
                 # Filter the DataFrame by the selected month and apply business logic
-                df_filtered, month = filter_dataframe_by_month(st.session_state.df)
+                df_filtered, month = filter_dataframe_by_month(df)
                 if df_filtered is not None:
-                    apply_business_logic(df_filtered, selected_sheet, month)
+                    bulk_punch_section(uploaded_file, workbook, sheet_names, month)
+                    apply_business_logic(df_filtered, selected_sheet, month, sheet_hash, uploaded_file)
     else:
         st.write("Please upload an Excel file to proceed.")
 
@@ -0,0 +1,41 @@
+import logging
+import time
+
+import streamlit as st
+
+from dump_query import AGGREGATIONS, GROUP_COLUMNS, MEASURE_COLUMNS, query_dump
+from dump_store import dump_months
+from main import DUMP_FILE_PATH
+
+def setup_page():
+    st.set_page_config(page_title="Dump Query", layout="wide")
+    st.title("Dump Query :mag:")
+
+def query_form():
+    # Filters, grouping and measures; returns the query_dump arguments
+    months = dump_months(DUMP_FILE_PATH)
+    selected_months = st.sidebar.multiselect("Months", months, default=months[-6:])
+    site_text = st.sidebar.text_input("Site name contains")
+    vendor_text = st.sidebar.text_input("Vendor contains")
+    group_by = st.multiselect("Group by", GROUP_COLUMNS, default=['vendor'])
+    measures = st.multiselect("Measures", MEASURE_COLUMNS, default=['selling amount'])
+    aggregation = st.selectbox("Aggregation", AGGREGATIONS)
+    contains = {column: text.strip() for column, text in (('site name', site_text), ('vendor', vendor_text)) if text.strip()}
+    return group_by, measures, aggregation, {'months': selected_months or None, 'contains': contains}
+
+def main():
+    setup_page()
+    group_by, measures, aggregation, filters = query_form()
+    if not measures:
+        st.write("Pick at least one measure.")
+        return
+    try:
+        started = time.perf_counter()
+        result = query_dump(DUMP_FILE_PATH, group_by, measures, aggregation, **filters)
+        st.caption(f"{len(result)} row(s) in {time.perf_counter() - started:.2f}s")
+        st.dataframe(result, hide_index=True)
+    except Exception as e:
+        st.error(f"Error querying the dump: {e}")
+        logging.error(f"Error querying the dump: {e}")
+
+main()
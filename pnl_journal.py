@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import uuid
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from pnl_store import PNL_KEY_COLUMNS, assign_cells, cached_pnl_frame, file_signature, format_pnl_keys, pnl_index, pnl_row_hashes, read_pnl_frame, remember_index, store_pnl_frame, values_differ, write_pnl_cells
+
+CHANGE_COLUMNS = PNL_KEY_COLUMNS + ['column', 'old value', 'new value']
+# 'old value' is the before-image undo restores; 'undo of' names the punch an undo reverted
+JOURNAL_COLUMNS = CHANGE_COLUMNS + ['timestamp', 'sheet', 'module', 'punch id', 'undo of']
+
+# Bytes at the end of the archive Undo reads first; doubled until the punch to undo is in them
+ARCHIVE_TAIL_BYTES = 256 * 1024
+
+# P&L file path -> (workbook signature, journal signature, journal-over-base view)
+_view_cache = {}
+
+def journal_path(p_and_l_file_path):
+    return f"{p_and_l_file_path}.journal.jsonl"
+
+def archive_path(p_and_l_file_path):
+    # Compacted records are kept here as the audit trail
+    return f"{p_and_l_file_path}.journal-archive.jsonl"
+
+def hashes_path(p_and_l_file_path):
+    # Row hashes of the last punch of every (cost centre, month)
+    return f"{p_and_l_file_path}.punch-hashes.json"
+
+def encode_value(value):
+    if isinstance(value, (datetime, date)):
+        return {'$datetime': pd.Timestamp(value).isoformat()}
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    raise TypeError(f"Cannot journal value {value!r} of type {type(value).__name__}")
+
+def decode_value(record):
+    return pd.Timestamp(record['$datetime']) if '$datetime' in record else record
+
+def journal_records(changes, sheet=None, module=None, undo_of=None):
+    # Stamp cell changes with when, from which sheet and by which module they were punched
+    records = changes[CHANGE_COLUMNS].astype(object).where(changes[CHANGE_COLUMNS].notna(), None)
+    records['timestamp'] = pd.Timestamp.now().isoformat()
+    records['sheet'] = sheet
+    records['module'] = module
+    records['punch id'] = uuid.uuid4().hex
+    records['undo of'] = undo_of
+    return records[JOURNAL_COLUMNS]
+
+def append_records(path, records):
+    with open(path, 'a', encoding='utf-8') as journal:
+        for record in records.to_dict('records'):
+            journal.write(json.dumps(record, default=encode_value) + '\n')
+
+def append_journal(p_and_l_file_path, records):
+    # A punch is one small append, whatever the size of the P&L
+    append_records(journal_path(p_and_l_file_path), records)
+
+def keyed_view(pnl_df):
+    # pnl_df keyed on (cost centre, month) for cell lookups; objects, so any punched value can be written back into it
+    return pnl_df.drop_duplicates(PNL_KEY_COLUMNS).set_index(PNL_KEY_COLUMNS).astype(object)
+
+def current_values(lookup, records):
+    # What the keyed view holds now in every (cost centre, month, column) cell named by records
+    values = pd.Series(None, index=records.index, dtype=object)
+    for column, group in records.groupby('column'):
+        if column in lookup.columns:
+            values.loc[group.index] = lookup[column].reindex(pd.MultiIndex.from_frame(group[PNL_KEY_COLUMNS])).to_numpy()
+    return values
+
+def accept_values(lookup, records):
+    # Write journaled records into the keyed view; keys and columns the P&L does not have are not shown by the view either
+    for column, group in latest_values(records).groupby('column'):
+        if column in lookup.columns:
+            keys = pd.MultiIndex.from_frame(group[PNL_KEY_COLUMNS])
+            present = keys.isin(lookup.index)
+            lookup.loc[keys[present], column] = group['new value'].to_numpy()[present]
+
+def append_punches(p_and_l_file_path, records):
+    # Compare-and-set append: a cell is journaled only if it still holds the 'old value' its punch read, so punches
+    # of other cells merge freely and only cells changed by someone else in between are rejected.
+    # The view is read and keyed once per flush, and every punch's accepted cells are written into the keyed view,
+    # so a later punch sees the earlier ones; the cached view then moves forward by what was appended.
+    # Returns the rejected records. Must run under the P&L file lock.
+    view = read_pnl_view(p_and_l_file_path)
+    lookup = keyed_view(view)
+    rejected = [records.iloc[:0]]
+    appended = [records.iloc[:0]]
+    for _, punch in records.groupby('punch id', sort=False):
+        current = current_values(lookup, punch)
+        moved = values_differ(current, punch['old value'])
+        conflicts = moved & values_differ(current, punch['new value'])
+        rejected.append(punch[conflicts])
+        # Cells that already hold the punched value need no record; it would carry the wrong before-image
+        if (~moved).any():
+            append_journal(p_and_l_file_path, punch[~moved])
+            appended.append(punch[~moved])
+            accept_values(lookup, punch[~moved])
+    appended = pd.concat(appended, ignore_index=True)
+    if not appended.empty:
+        store_view(p_and_l_file_path, overlay_journal(view, appended))
+    return pd.concat(rejected, ignore_index=True)
+
+def read_records(path, start=0):
+    # Records of a journal or archive file from a byte offset on; a line the offset falls inside is skipped
+    try:
+        with open(path, 'rb') as journal:
+            # From the byte before the offset, so the first line read is the partial one even when the offset starts a line
+            journal.seek(max(start - 1, 0))
+            lines = [line.decode('utf-8') for line in journal.read().splitlines()]
+    except FileNotFoundError:
+        return pd.DataFrame(columns=JOURNAL_COLUMNS)
+    if start:
+        lines = lines[1:]
+    records = []
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            records.append(json.loads(line, object_hook=decode_value))
+        except json.JSONDecodeError:
+            # Only the last line can be half-written by an append in progress
+            if line_number != len(lines):
+                logging.error(f"Skipping corrupt journal line {line_number} in {path}")
+    return pd.DataFrame(records, columns=JOURNAL_COLUMNS)
+
+def read_journal(p_and_l_file_path):
+    return read_records(journal_path(p_and_l_file_path))
+
+def latest_values(records):
+    # The last journaled value of every (cost centre, month, column)
+    return records.drop_duplicates(subset=PNL_KEY_COLUMNS + ['column'], keep='last')
+
+def overlay_journal(pnl_df, records):
+    # Journal-over-base view: cells with a journal record show its latest value, the rest come from the workbook
+    latest = latest_values(records)
+    latest = latest[latest['column'].isin(pnl_df.columns)]
+    if latest.empty:
+        return pnl_df
+    values = latest.pivot(index=PNL_KEY_COLUMNS, columns='column', values='new value')
+    journaled = latest.assign(journaled=True).pivot(index=PNL_KEY_COLUMNS, columns='column', values='journaled').notna()
+
+    target_index = pnl_index(pnl_df)
+    touched = target_index.isin(values.index)
+    old_values = pnl_df.loc[touched, values.columns]
+    incoming = values.reindex(target_index[touched])
+    incoming.index = old_values.index
+    mask = journaled.reindex(target_index[touched])
+    mask.index = old_values.index
+    return assign_cells(pnl_df, touched, incoming.where(mask, old_values))
+
+def journal_signature(p_and_l_file_path):
+    try:
+        return file_signature(journal_path(p_and_l_file_path))
+    except FileNotFoundError:
+        return None
+
+def read_pnl_view(p_and_l_file_path):
+    # Cached journal-over-base view of the P&L, rebuilt when the workbook or the journal changed.
+    # The frame is shared across modules and sessions, so callers must not modify it in place.
+    base_signature = file_signature(p_and_l_file_path)
+    signature = journal_signature(p_and_l_file_path)
+    cached = _view_cache.get(p_and_l_file_path)
+    if cached is not None and cached[:2] == (base_signature, signature):
+        return cached[2]
+    view = overlay_journal(read_pnl_frame(p_and_l_file_path), read_journal(p_and_l_file_path))
+    store_view(p_and_l_file_path, view, base_signature, signature)
+    return view
+
+def store_view(p_and_l_file_path, view, base_signature=None, signature=None):
+    # Signatures default to the files as they are now, for a view the caller knows to match them
+    _view_cache[p_and_l_file_path] = (base_signature or file_signature(p_and_l_file_path),
+                                      signature or journal_signature(p_and_l_file_path), view)
+    remember_index(('view', p_and_l_file_path), view)
+
+def compact(p_and_l_file_path):
+    # Fold the journal into the workbook in one bulk write, then move its records to the archive.
+    # Records of keys or columns the workbook no longer has stay in the journal instead of being archived unwritten.
+    # Must run under the P&L file lock; replaying a journal that was already folded in is harmless.
+    records = read_journal(p_and_l_file_path)
+    if records.empty:
+        return 0
+    base = cached_pnl_frame(p_and_l_file_path)
+    punch_hashes = read_punch_hashes(p_and_l_file_path)
+    unwritten = write_pnl_cells(p_and_l_file_path, latest_values(records))
+    kept = cell_keys(records).isin(cell_keys(unwritten))
+    # Folding the journal in does not change what was punched, so the row hashes stay valid for the new workbook
+    write_punch_hashes(p_and_l_file_path, punch_hashes)
+    if base is not None:
+        # We know what we just wrote, so the cached frame moves forward without re-parsing the workbook
+        store_pnl_frame(p_and_l_file_path, overlay_journal(base, records[~kept]))
+    append_records(archive_path(p_and_l_file_path), records[~kept])
+    if kept.any():
+        logging.error(f"Kept {kept.sum()} journal record(s) of {p_and_l_file_path} whose cells are not in the workbook: "
+                      f"{format_pnl_keys(unwritten[PNL_KEY_COLUMNS].drop_duplicates().itertuples(index=False))}")
+        replace_records(journal_path(p_and_l_file_path), records[kept])
+    else:
+        os.remove(journal_path(p_and_l_file_path))
+    logging.info(f"Compacted {(~kept).sum()} journal record(s) into {p_and_l_file_path}.")
+    return int((~kept).sum())
+
+def cell_keys(records):
+    return pd.MultiIndex.from_frame(records[PNL_KEY_COLUMNS + ['column']])
+
+def replace_records(path, records):
+    # Replaced in one rename so readers never see a half-written journal
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    append_records(temp_path, records)
+    os.replace(temp_path, path)
+
+def last_punch(records, sheet, month):
+    # Latest punch of this sheet and month that is neither an undo nor already undone; None when there is none
+    punches = records[(records['sheet'] == sheet) & (records['month'] == month) & records['undo of'].isna()]
+    punches = punches[~punches['punch id'].isin(records['undo of'].dropna())]
+    return None if punches.empty else punches.iloc[-1]
+
+def punch_history(p_and_l_file_path, sheet, month):
+    # (records from the last undoable punch of this sheet and month onwards, that punch); the punch is None when there is none.
+    # The pending journal is looked at first. Only when the punch was already compacted is the archive read, backwards
+    # from its end and only as far as the punch: everything that can have overwritten its cells came after it.
+    journal = read_journal(p_and_l_file_path)
+    punch = last_punch(journal, sheet, month)
+    if punch is not None:
+        return journal, punch
+    tail_bytes = ARCHIVE_TAIL_BYTES
+    while True:
+        archive_size = archive_bytes(p_and_l_file_path)
+        start = max(archive_size - tail_bytes, 0)
+        tail = read_records(archive_path(p_and_l_file_path), start)
+        # Empty chunks are left out and the rest kept as objects, so a column that is all blank in one chunk
+        # neither changes the other's dtype nor makes the concat warn
+        chunks = [chunk.astype(object) for chunk in (tail, journal) if not chunk.empty]
+        records = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else (chunks or [tail])[0]
+        # A compaction running meanwhile can move journal records we already read into the archive
+        records = records.drop_duplicates(subset=['punch id'] + PNL_KEY_COLUMNS + ['column'], keep='last')
+        punch = last_punch(records, sheet, month)
+        # The punch is whole once the tail starts before its first record
+        if start == 0 or (punch is not None and records['punch id'].iloc[0] != punch['punch id']):
+            return records, punch
+        tail_bytes *= 2
+
+def undo_changes(records, punch_id):
+    # Changes restoring a punch's before-image, for the cells no later punch or clear has overwritten.
+    # Returns (changes, number of cells left alone because they changed since).
+    # Punches already undone are dropped along with their undo records, so the cells they wrote count as the
+    # earlier punch's again and undoing several punches in a row reverts each of them whole.
+    undone = records['undo of'].dropna()
+    latest = latest_values(records[~records['punch id'].isin(undone) & ~records['undo of'].isin(undone)])
+    restorable = latest[latest['punch id'] == punch_id]
+    punched = (records['punch id'] == punch_id).sum()
+    changes = restorable.rename(columns={'old value': 'new value', 'new value': 'old value'})[CHANGE_COLUMNS]
+    return changes.reset_index(drop=True), punched - len(changes)
+
+def archive_bytes(p_and_l_file_path):
+    try:
+        return os.path.getsize(archive_path(p_and_l_file_path))
+    except FileNotFoundError:
+        return 0
+
+def journal_size(p_and_l_file_path):
+    try:
+        return os.path.getsize(journal_path(p_and_l_file_path))
+    except FileNotFoundError:
+        return 0
+
+def read_punch_hashes(p_and_l_file_path):
+    # {(cost centre, month): row hash}; empty when P&L.xlsx was changed outside the app since the hashes were stored
+    try:
+        with open(hashes_path(p_and_l_file_path), encoding='utf-8') as hashes_file:
+            stored = json.load(hashes_file, object_hook=decode_value)
+        signature = file_signature(p_and_l_file_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if tuple(stored['signature']) != signature:
+        return {}
+    return {(cost_centre, month): row_hash for cost_centre, month, row_hash in stored['hashes']}
+
+def write_punch_hashes(p_and_l_file_path, punch_hashes):
+    # Replaced in one rename so readers never see a half-written file
+    stored = {
+        'signature': list(file_signature(p_and_l_file_path)),
+        'hashes': [[cost_centre, month, row_hash] for (cost_centre, month), row_hash in punch_hashes.items()],
+    }
+    temp_path = f"{hashes_path(p_and_l_file_path)}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as hashes_file:
+        json.dump(stored, hashes_file, default=encode_value)
+    os.replace(temp_path, hashes_path(p_and_l_file_path))
+
+def store_punch_hashes(p_and_l_file_path, updates):
+    # Apply (cost centre, month, row hash) updates; a missing row hash forgets the key. Must run under the P&L file lock.
+    punch_hashes = read_punch_hashes(p_and_l_file_path)
+    for cost_centre, month, row_hash in updates[PNL_KEY_COLUMNS + ['row hash']].itertuples(index=False):
+        if pd.isna(row_hash):
+            punch_hashes.pop((cost_centre, month), None)
+        else:
+            punch_hashes[(cost_centre, month)] = row_hash
+    write_punch_hashes(p_and_l_file_path, punch_hashes)
+
+def unpunched_rows(p_and_l_file_path, pnl_rows):
+    # Mask of the mapped P&L rows whose content changed since they were last punched,
+    # and the (cost centre, month, row hash) updates to store once those rows are written
+    hashes = pnl_row_hashes(pnl_rows)
+    punch_hashes = read_punch_hashes(p_and_l_file_path)
+    changed = np.array([punch_hashes.get(key) != row_hash for key, row_hash in hashes.items()], dtype=bool)
+    return changed, hashes[changed].rename('row hash').reset_index()
@@ -0,0 +1,202 @@
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+# Columns that identify a row of P&L.xlsx
+PNL_KEY_COLUMNS = ['cost centre', 'month']
+
+# P&L file path -> (file signature, {column name: column number}, {(cost centre, month): [row numbers]})
+_row_index_cache = {}
+# P&L file path -> (file signature, parsed and normalized workbook frame)
+_frame_cache = {}
+# Cache key -> (frame, its (cost centre, month) index) for the frames the caches hand out
+_frame_indexes = {}
+
+def pnl_key_column(pnl_data):
+    # Business logic output is keyed on 'identifier' (review id, else cost centre) or directly on 'cost centre'
+    return 'identifier' if 'identifier' in pnl_data.columns else 'cost centre'
+
+def index_pnl_data(pnl_data):
+    # Index the computed P&L rows by (cost centre, month) so they align with P&L.xlsx
+    indexed = pnl_data.set_index([pnl_key_column(pnl_data), 'month'])
+    indexed.index.names = PNL_KEY_COLUMNS
+    return indexed
+
+def mapped_pnl_rows(pnl_data, pnl_mapping):
+    # Computed P&L rows renamed to P&L columns and keyed on (cost centre, month), limited to the mapped columns
+    rows = index_pnl_data(pnl_data.rename(columns=pnl_mapping))
+    return rows[[col for col in dict.fromkeys(pnl_mapping.values()) if col in rows.columns]]
+
+def pnl_row_hashes(pnl_rows):
+    # One content hash per (cost centre, month) over the P&L columns a punch would write
+    names_hash = pd.util.hash_array(np.array([','.join(pnl_rows.columns)], dtype=object))[0]
+    hashes = pd.util.hash_pandas_object(pnl_rows, index=False) ^ names_hash
+    return hashes.map('{:016x}'.format)
+
+def pnl_index(pnl_df):
+    # Cached frames reuse the key index built when they were cached
+    for frame, index in list(_frame_indexes.values()):
+        if frame is pnl_df:
+            return index
+    return pd.MultiIndex.from_frame(pnl_df[PNL_KEY_COLUMNS])
+
+def remember_index(cache_key, pnl_df):
+    _frame_indexes[cache_key] = (pnl_df, pd.MultiIndex.from_frame(pnl_df[PNL_KEY_COLUMNS]))
+
+def values_differ(old, new):
+    # NaN-aware cell comparison: two blanks are equal, a blank and a value are not
+    return ~((old == new) | (old.isna() & new.isna()))
+
+def cell_changes(pnl_df, old_values, new_values):
+    # One (cost centre, month, column, old value, new value) record per cell that differs
+    rows, cols = values_differ(old_values, new_values).to_numpy().nonzero()
+    keys = pnl_df.loc[old_values.index, PNL_KEY_COLUMNS].to_numpy()[rows]
+    changes = pd.DataFrame({
+        'cost centre': keys[:, 0],
+        'month': keys[:, 1],
+        'column': old_values.columns.to_numpy()[cols],
+        'old value': old_values.to_numpy()[rows, cols],
+        'new value': new_values.to_numpy()[rows, cols],
+    })
+    return changes.drop_duplicates(subset=PNL_KEY_COLUMNS + ['column'], ignore_index=True)
+
+def updated_rows_report(pnl_df, changes):
+    # Cost centre, month and site name of every changed row, followed by only the cells that changed
+    columns = [col for col in pnl_df.columns if col in set(changes['column'])]
+    report = changes.pivot(index=PNL_KEY_COLUMNS, columns='column', values='new value').reindex(columns=columns)
+    id_columns = list(PNL_KEY_COLUMNS)
+    if 'site name' in pnl_df.columns:
+        site_names = pnl_df.drop_duplicates(PNL_KEY_COLUMNS).set_index(PNL_KEY_COLUMNS)['site name']
+        report.insert(0, 'site name', site_names.reindex(report.index))
+        id_columns.append('site name')
+    report = report.reset_index()
+    report.columns = [col.title() for col in id_columns] + [f"Updated {col.title().replace('_', ' ')}" for col in columns]
+    return report
+
+def assign_cells(pnl_df, touched, values):
+    # Copy of pnl_df with values written into the touched rows in one assignment
+    updated_df = pnl_df.copy()
+    # Columns receiving values of another dtype (e.g. text into a numeric column) are widened to object first
+    widened = [col for col in values.columns if values[col].dtype != updated_df[col].dtype]
+    updated_df[widened] = updated_df[widened].astype(object)
+    updated_df.loc[touched, values.columns] = values
+    return updated_df
+
+def apply_pnl_update(pnl_df, pnl_data, pnl_mapping):
+    # Write the mapped columns of pnl_data into a copy of pnl_df in one assignment aligned on (cost centre, month).
+    # Returns (updated P&L, changed cells, unmatched keys); the first two are None when any key is unmatched.
+    new_values = mapped_pnl_rows(pnl_data, pnl_mapping)
+    columns = list(new_values.columns)
+    target_index = pnl_index(pnl_df)
+
+    unmatched = new_values.index.difference(target_index)
+    if len(unmatched):
+        return None, None, unmatched
+
+    touched = target_index.isin(new_values.index)
+    old_values = pnl_df.loc[touched, columns]
+    incoming = new_values[columns].reindex(target_index[touched])
+    incoming.index = old_values.index
+    # Blank computed values keep what is already in the P&L
+    merged = incoming.where(incoming.notna(), old_values)
+
+    return assign_cells(pnl_df, touched, merged), cell_changes(pnl_df, old_values, merged), unmatched
+
+def clear_pnl_keys(pnl_df, pnl_data, pnl_mapping):
+    # Null the mapped columns of every P&L row keyed by pnl_data in one assignment.
+    # Returns (cleared P&L, changed cells, missing keys); the first two are None when any key is missing.
+    keys = index_pnl_data(pnl_data).index
+    target_index = pnl_index(pnl_df)
+
+    missing = keys.difference(target_index)
+    if len(missing):
+        return None, None, missing
+
+    columns = [col for col in pnl_mapping.values() if col in pnl_df.columns]
+    touched = target_index.isin(keys)
+    old_values = pnl_df.loc[touched, columns]
+    cleared_df = pnl_df.copy()
+    cleared_df.loc[touched, columns] = None
+    return cleared_df, cell_changes(pnl_df, old_values, cleared_df.loc[touched, columns]), missing
+
+def without_cells(changes, cells):
+    # changes minus the (cost centre, month, column) cells listed in cells
+    cell_columns = PNL_KEY_COLUMNS + ['column']
+    dropped = pd.MultiIndex.from_frame(cells[cell_columns])
+    return changes[~pd.MultiIndex.from_frame(changes[cell_columns]).isin(dropped)]
+
+def format_pnl_keys(keys):
+    return ", ".join(f"{cost_centre} ({month})" for cost_centre, month in keys)
+
+#-------------------------------------------------------Cell-level writer--------------------------------------------------
+
+def normalize_cell(value):
+    # Same normalization load_pnl_data applies to every P&L value
+    return value.strip().lower() if isinstance(value, str) else value
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def cached_pnl_frame(p_and_l_file_path):
+    # The cached workbook frame if it is still current, without parsing anything
+    cached = _frame_cache.get(p_and_l_file_path)
+    if cached is not None and cached[0] == file_signature(p_and_l_file_path):
+        return cached[1]
+    return None
+
+def store_pnl_frame(p_and_l_file_path, pnl_df, signature=None):
+    _frame_cache[p_and_l_file_path] = (signature or file_signature(p_and_l_file_path), pnl_df)
+    remember_index(('base', p_and_l_file_path), pnl_df)
+
+def read_pnl_frame(p_and_l_file_path):
+    # Parsed, normalized P&L.xlsx shared by every module; re-read only when the file's mtime or size changed.
+    # The frame is shared, so callers must not modify it in place.
+    pnl_df = cached_pnl_frame(p_and_l_file_path)
+    if pnl_df is None:
+        # Signature taken before reading: a write racing the read invalidates the entry instead of hiding behind it
+        signature = file_signature(p_and_l_file_path)
+        pnl_df = pd.read_excel(p_and_l_file_path, header=0)
+        pnl_df = pnl_df.map(normalize_cell)
+        store_pnl_frame(p_and_l_file_path, pnl_df, signature)
+    return pnl_df
+
+def build_row_index(sheet):
+    header = [normalize_cell(cell.value) for cell in sheet[1]]
+    columns = {name: position for position, name in enumerate(header, start=1) if name is not None}
+    key_positions = [columns[col] - 1 for col in PNL_KEY_COLUMNS]
+    rows = defaultdict(list)
+    for row_number, values in enumerate(sheet.iter_rows(min_row=2, max_col=max(key_positions) + 1, values_only=True), start=2):
+        rows[tuple(normalize_cell(values[position]) for position in key_positions)].append(row_number)
+    return columns, rows
+
+def pnl_row_index(p_and_l_file_path, sheet):
+    # (cost centre, month) -> worksheet rows, rebuilt only when the file changed since we last indexed it
+    cached = _row_index_cache.get(p_and_l_file_path)
+    if cached is not None and cached[0] == file_signature(p_and_l_file_path):
+        return cached[1], cached[2]
+    columns, rows = build_row_index(sheet)
+    _row_index_cache[p_and_l_file_path] = (file_signature(p_and_l_file_path), columns, rows)
+    return columns, rows
+
+def write_pnl_cells(p_and_l_file_path, changes):
+    # Open the workbook once, write only the changed cells and save; formatting and formulas elsewhere are kept.
+    # Returns the changes that were not written because their (cost centre, month) or column is not in the workbook.
+    if changes.empty:
+        return changes
+    workbook = load_workbook(p_and_l_file_path)
+    sheet = workbook.worksheets[0]
+    columns, rows = pnl_row_index(p_and_l_file_path, sheet)
+    writable = np.array([(cost_centre, month) in rows and column in columns
+                         for cost_centre, month, column in changes[PNL_KEY_COLUMNS + ['column']].itertuples(index=False)], dtype=bool)
+    for cost_centre, month, column, new_value in changes.loc[writable, PNL_KEY_COLUMNS + ['column', 'new value']].itertuples(index=False):
+        for row_number in rows[(cost_centre, month)]:
+            # Assigned directly: sheet.cell(..., value=None) would leave the cell untouched
+            sheet.cell(row=row_number, column=columns[column]).value = None if pd.isna(new_value) else new_value
+    workbook.save(p_and_l_file_path)
+    # Rows did not move, so the index stays valid for the file we just wrote
+    _row_index_cache[p_and_l_file_path] = (file_signature(p_and_l_file_path), columns, rows)
+    return changes[~writable]
@@ -0,0 +1,80 @@
+import hashlib
+import sys
+import threading
+
+import pandas as pd
+
+from pnl_store import file_signature
+from sized_cache import SizedCache
+
+# Bounds of the process-wide result cache; the least recently used results go first
+MAX_RESULTS = 128
+MAX_RESULT_BYTES = 512 * 1024 * 1024
+
+# (module name, function name, sheet hash, month, source hash) -> result
+_results = SizedCache(MAX_RESULT_BYTES, MAX_RESULTS)
+# Module file path -> (file signature, source hash)
+_source_hashes = {}
+_lock = threading.RLock()
+
+def result_size(value):
+    # Approximate bytes held by a result: frames are measured deeply, containers item by item
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_size(key) + result_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def invalidate(module_name):
+    # Drop every cached result of a module
+    with _lock:
+        for key in [key for key in _results.keys() if key[0] == module_name]:
+            _results.pop(key)
+
+def source_hash(module):
+    # Hash of the module's source file, re-read only when its mtime or size changed.
+    # An edited module has its cached results dropped right away instead of waiting for them to age out.
+    path = module.__file__
+    signature = file_signature(path)
+    with _lock:
+        cached = _source_hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path, 'rb') as source:
+            digest = hashlib.sha1(source.read()).hexdigest()
+        if cached is not None and cached[1] != digest:
+            invalidate(module.__name__)
+        _source_hashes[path] = (signature, digest)
+        return digest
+
+def result_key(module, function_name, sheet_hash, month):
+    return (module.__name__, function_name, sheet_hash, month, source_hash(module))
+
+def cached_result(module, function_name, sheet_hash, month):
+    # The cached result of module.<function_name> for this sheet and month, or None
+    key = result_key(module, function_name, sheet_hash, month)
+    with _lock:
+        return _results.get(key)
+
+def store_result(module, function_name, sheet_hash, month, result):
+    # Results are shared by every session, so neither the caller nor later readers may modify them
+    key = result_key(module, function_name, sheet_hash, month)
+    size = result_size(result)
+    with _lock:
+        # Another session may have stored the same result while this one computed it
+        _results.add(key, result, size)
+        _results.evict()
+
+def cached_call(module, function_name, sheet_hash, month, *args):
+    # module.<function_name>(*args) memoized on (sheet hash, month, module source).
+    # None is not cached: the function has reported an error and should report it again.
+    result = cached_result(module, function_name, sheet_hash, month)
+    if result is None:
+        result = getattr(module, function_name)(*args)
+        if result is not None:
+            store_result(module, function_name, sheet_hash, month, result)
+    return result
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+class SizedCache:
+    # Least recently used cache bounded by the approximate bytes of its entries and, optionally, by their number.
+    # Not locked: every module keeping one guards it with its own lock.
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # Key -> (value, approximate bytes), least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def add(self, key, value, size):
+        # An entry another caller added meanwhile is kept
+        if key not in self._entries:
+            self._entries[key] = (value, size)
+            self.bytes += size
+
+    def pop(self, key):
+        value, size = self._entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def over_budget(self):
+        too_many = self.max_entries is not None and len(self._entries) > self.max_entries
+        # The most recent entry is kept even when it alone is over the byte budget
+        return too_many or (self.bytes > self.max_bytes and len(self._entries) > 1)
+
+    def evict(self, victim=None):
+        # Drop entries until within budget, least recently used first unless victim(keys) picks another one.
+        # Returns the evicted keys.
+        evicted = []
+        while self.over_budget():
+            key = victim(self._entries) if victim is not None else next(iter(self._entries))
+            self.pop(key)
+            evicted.append(key)
+        return evicted
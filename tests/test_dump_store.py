@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+from dump_store import import_legacy_dump, read_dump, read_dump_summary
+from write_coordinator import write_dump_rows
+
+@pytest.fixture
+def dump_path(tmp_path):
+    return str(tmp_path / "Dump.xlsx")
+
+def mis_rows():
+    return pd.DataFrame({
+        'date': pd.to_datetime(['2024-01-02', '2024-01-02', '2024-01-03']),
+        'month': ["jan'24"] * 3,
+        'site name': ['gojek ncr'] * 3,
+        'session': ['lunch', 'lunch', 'dinner'],
+        'buying pax': [10.0, 10.0, 12.0],
+        'selling amount': [1500.0, 1500.0, 1800.0],
+    })
+
+def test_redump_after_import_skips_the_imported_rows(dump_path):
+    mis_rows().to_excel(dump_path, index=False)
+    assert import_legacy_dump(dump_path) == (3, {})
+
+    assert write_dump_rows(dump_path, mis_rows(), 'Gojek_NCR') == 3
+    assert len(read_dump(dump_path)) == 3
+
+def test_redump_after_import_appends_rows_the_import_did_not_have(dump_path):
+    mis_rows().iloc[:2].to_excel(dump_path, index=False)
+    import_legacy_dump(dump_path)
+
+    assert write_dump_rows(dump_path, mis_rows(), 'Gojek_NCR') == 2
+    assert len(read_dump(dump_path)) == 3
+    assert read_dump_summary(dump_path)['rows'] == 3
@@ -0,0 +1,66 @@
+import pandas as pd
+import pytest
+
+from pnl_journal import (CHANGE_COLUMNS, append_punches, archive_path, compact, journal_records, punch_history, read_journal, read_pnl_view,
+                         read_records, undo_changes)
+
+MONTH = "jan'24"
+
+@pytest.fixture
+def pnl_path(tmp_path):
+    path = str(tmp_path / "P&L.xlsx")
+    pd.DataFrame({'cost centre': ['a', 'b'], 'month': [MONTH, MONTH],
+                  'buying pax': [None, None], 'selling pax': [None, None]}).to_excel(path, index=False)
+    return path
+
+def cell(pnl_path, column, cost_centre='a'):
+    view = read_pnl_view(pnl_path)
+    return view.loc[view['cost centre'] == cost_centre, column].iloc[0]
+
+def punch(pnl_path, sheet, values):
+    # Punch {(cost centre, column): value} over what the view holds now, the way a sheet's Punch does
+    changes = pd.DataFrame([[cost_centre, MONTH, column, cell(pnl_path, column, cost_centre), value]
+                            for (cost_centre, column), value in values.items()], columns=CHANGE_COLUMNS)
+    assert append_punches(pnl_path, journal_records(changes, sheet, 'business_logic_1')).empty
+
+def undo(pnl_path, sheet):
+    # Same steps as main.undo_last_punch; returns how many cells were left alone
+    records, last = punch_history(pnl_path, sheet, MONTH)
+    changes, skipped = undo_changes(records, last['punch id'])
+    rejected = append_punches(pnl_path, journal_records(changes, sheet, 'business_logic_1', undo_of=last['punch id']))
+    return skipped + len(rejected)
+
+@pytest.mark.parametrize('compacted', [False, True])
+def test_two_undos_in_a_row_revert_both_punches_whole(pnl_path, compacted):
+    punch(pnl_path, 'Sheet', {('a', 'buying pax'): 100, ('a', 'selling pax'): 50})
+    punch(pnl_path, 'Sheet', {('a', 'buying pax'): 200})
+    if compacted:
+        compact(pnl_path)
+
+    assert undo(pnl_path, 'Sheet') == 0
+    assert cell(pnl_path, 'buying pax') == 100
+    if compacted:
+        compact(pnl_path)
+
+    assert undo(pnl_path, 'Sheet') == 0
+    assert pd.isna(cell(pnl_path, 'buying pax'))
+    assert pd.isna(cell(pnl_path, 'selling pax'))
+    assert punch_history(pnl_path, 'Sheet', MONTH)[1] is None
+
+def test_undo_leaves_cells_of_a_later_punch_alone(pnl_path):
+    punch(pnl_path, 'Sheet', {('a', 'buying pax'): 100, ('a', 'selling pax'): 50})
+    punch(pnl_path, 'Other', {('a', 'buying pax'): 300})
+
+    assert undo(pnl_path, 'Sheet') == 1
+    assert cell(pnl_path, 'buying pax') == 300
+    assert pd.isna(cell(pnl_path, 'selling pax'))
+
+def test_compact_keeps_records_of_keys_missing_from_the_workbook(pnl_path):
+    punch(pnl_path, 'Sheet', {('a', 'buying pax'): 100})
+    records = journal_records(pd.DataFrame([['gone', MONTH, 'buying pax', None, 5]], columns=CHANGE_COLUMNS), 'Sheet', 'business_logic_1')
+    assert append_punches(pnl_path, records).empty
+
+    assert compact(pnl_path) == 1
+    assert read_journal(pnl_path)['cost centre'].tolist() == ['gone']
+    assert read_records(archive_path(pnl_path))['cost centre'].tolist() == ['a']
+    assert pd.read_excel(pnl_path).loc[0, 'buying pax'] == 100
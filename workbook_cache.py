@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import threading
+import time
+import zipfile
+from xml.etree import ElementTree
+
+import pandas as pd
+
+from sized_cache import SizedCache
+
+# Bytes of parsed sheets kept for all sessions together; sheets of workbooks no session holds are evicted first
+SHEET_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Seconds after its last run that a session stops holding its workbook; Streamlit does not tell us when a session ends
+HOLD_SECONDS = 30 * 60
+
+# Sheet list of an xlsx package and the namespace of its elements
+WORKBOOK_PART = 'xl/workbook.xml'
+SPREADSHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# (workbook hash, sheet name) -> (frame, sheet hash)
+_sheets = SizedCache(SHEET_CACHE_BYTES)
+# Workbook hash -> sheet names
+_sheet_names = {}
+# Workbook hash -> {id of a session working on it: monotonic time of the session's last run}
+_holders = {}
+_lock = threading.RLock()
+
+def workbook_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def frame_hash(df):
+    # Content hash of a parsed sheet; together with the month it identifies the rows a module is given.
+    # Row hashes are digested in order, after the column names and dtypes, so a re-upload that only fixes a header differs.
+    digest = hashlib.sha1(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def xlsx_sheet_names(workbook_file):
+    # Sheet names from the workbook manifest inside the xlsx zip; no worksheet is opened or parsed
+    with zipfile.ZipFile(workbook_file) as package, package.open(WORKBOOK_PART) as manifest:
+        return [element.get('name') for _, element in ElementTree.iterparse(manifest) if element.tag == f"{SPREADSHEET_NS}sheet"]
+
+def workbook_sheet_names(workbook, workbook_file):
+    # Sheet names of a workbook, read from its manifest on a miss
+    with _lock:
+        if workbook in _sheet_names:
+            return _sheet_names[workbook]
+    try:
+        sheet_names = xlsx_sheet_names(workbook_file)
+    except zipfile.BadZipFile:
+        # Legacy .xls is not a zip package; the ExcelFile is closed as soon as the names are read
+        workbook_file.seek(0)
+        with pd.ExcelFile(workbook_file) as excel_file:
+            sheet_names = excel_file.sheet_names
+    with _lock:
+        _sheet_names[workbook] = sheet_names
+    return sheet_names
+
+def release(workbook, session_id):
+    # Must run under the lock
+    _holders[workbook].pop(session_id, None)
+    if not _holders[workbook]:
+        del _holders[workbook]
+        _sheet_names.pop(workbook, None)
+
+def release_expired():
+    # Holds of sessions that have not run for HOLD_SECONDS, most likely closed tabs, are dropped
+    expiry = time.monotonic() - HOLD_SECONDS
+    with _lock:
+        for workbook, sessions in list(_holders.items()):
+            for session_id in [session_id for session_id, last_run in sessions.items() if last_run < expiry]:
+                release(workbook, session_id)
+
+def evict():
+    # Least recently used sheets go first, those of workbooks no session holds before any other
+    with _lock:
+        release_expired()
+        for key in _sheets.evict(lambda keys: next((key for key in keys if key[0] not in _holders), next(iter(keys)))):
+            logging.info(f"Evicted sheet '{key[1]}' of workbook {key[0][:8]} from the sheet cache.")
+
+def hold(session_id, workbook):
+    # The session works on this workbook and no longer on the one it held before. Called on every run to renew the hold.
+    with _lock:
+        for held in [held for held, sessions in _holders.items() if session_id in sessions and held != workbook]:
+            release(held, session_id)
+        _holders.setdefault(workbook, {})[session_id] = time.monotonic()
+        evict()
+
+def load_sheet(workbook, sheet_name, parse):
+    # (frame, sheet hash) of a sheet, parsed once for every session that uploaded the same workbook.
+    # parse() runs only on a miss; None from it is passed on uncached. The frame is shared, so callers must not modify it.
+    key = (workbook, sheet_name)
+    with _lock:
+        cached = _sheets.get(key)
+    if cached is not None:
+        return cached
+
+    df = parse()
+    if df is None:
+        return None, None
+    sheet_hash = frame_hash(df)
+    with _lock:
+        # Another session may have parsed the same sheet meanwhile
+        _sheets.add(key, (df, sheet_hash), int(df.memory_usage(deep=True).sum()))
+        evict()
+    return df, sheet_hash
@@ -0,0 +1,190 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import pandas as pd
+
+from dump_store import append_dump_rows, conform_dump_rows, dump_row_hashes, replace_dump_partitions
+from pnl_journal import JOURNAL_COLUMNS, append_punches, compact, journal_records, journal_size, store_punch_hashes
+from pnl_store import PNL_KEY_COLUMNS
+
+# Seconds to wait for another process to release a file before giving up
+LOCK_TIMEOUT = 120
+# A lock file older than this was left behind by a writer that crashed
+STALE_LOCK_AGE = 600
+# Seconds a reviewer waits for their queued write to be flushed
+WRITE_TIMEOUT = 300
+# Seconds of writer idleness after which pending P&L journals are folded into their workbooks
+COMPACT_INTERVAL = 60
+# A journal that grows past this is compacted right after the flush, even when the writer is busy
+COMPACT_JOURNAL_BYTES = 1024 * 1024
+
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+# P&L files whose journals this process compacts
+_journaled_paths = set()
+
+class FileLock:
+    # Cross-process lock on a shared file, held by whoever created "<path>.lock"
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.lock_path = f"{path}.lock"
+        self.timeout = timeout
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                if self.is_stale():
+                    logging.warning(f"Removing stale lock file {self.lock_path}")
+                    self.release()
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for {self.lock_path}")
+                time.sleep(0.1)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def is_stale(self):
+        try:
+            return time.time() - os.path.getmtime(self.lock_path) > STALE_LOCK_AGE
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+# kind -> function writing the concatenated payloads of one flush to a path; what it returns goes to every future
+WRITERS = {
+    'journal': append_punches,
+    'dump': append_dump_rows,
+    'dump replace': replace_dump_partitions,
+    'punch hashes': store_punch_hashes,
+}
+
+def flush(batch):
+    # One read-modify-write per target file for everything queued since the last flush
+    groups = {}
+    for kind, path, payload, future in batch:
+        groups.setdefault((kind, path), []).append((payload, future))
+        if kind == 'journal':
+            _journaled_paths.add(path)
+
+    for (kind, path), operations in groups.items():
+        futures = [future for _, future in operations]
+        try:
+            with FileLock(path):
+                # Concatenated in submission order, so a later punch of the same cell wins
+                result = WRITERS[kind](path, pd.concat([payload for payload, _ in operations], ignore_index=True))
+                # The dump's legacy workbook is gone once it has been imported into the dataset
+                if os.path.exists(path):
+                    os.chmod(path, 0o666)
+            logging.info(f"Flushed {len(operations)} queued {kind} write(s) to {path}.")
+        except Exception as e:
+            logging.error(f"Error flushing {kind} writes to {path}: {e}")
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(result)
+
+def compact_journals(min_bytes=1):
+    for path in list(_journaled_paths):
+        if journal_size(path) < min_bytes:
+            continue
+        try:
+            with FileLock(path):
+                compact(path)
+                os.chmod(path, 0o666)
+        except Exception as e:
+            logging.error(f"Error compacting the journal of {path}: {e}")
+            continue
+        if journal_size(path) == 0:
+            _journaled_paths.discard(path)
+
+def writer_loop():
+    while True:
+        try:
+            batch = [_queue.get(timeout=COMPACT_INTERVAL)]
+        except queue.Empty:
+            compact_journals()
+            continue
+        while True:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        flush(batch)
+        compact_journals(min_bytes=COMPACT_JOURNAL_BYTES)
+
+def ensure_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=writer_loop, name="pnl-dump-writer", daemon=True)
+            _writer.start()
+
+def submit(kind, path, payload):
+    # Queue a write for the single writer thread; the returned future completes when its flush does
+    ensure_writer()
+    future = Future()
+    _queue.put((kind, path, payload, future))
+    return future
+
+def write_journaled(p_and_l_file_path, records, row_hashes=None):
+    # Returns the records rejected because their cells changed since they were read.
+    # The touched keys' row hashes are forgotten before the journal write and stored again only for keys that landed,
+    # so a failed or rejected write can never leave a hash claiming the P&L is up to date.
+    touched = records[PNL_KEY_COLUMNS].drop_duplicates()
+    if not touched.empty:
+        submit('punch hashes', p_and_l_file_path, touched.assign(**{'row hash': None})).result(timeout=WRITE_TIMEOUT)
+    rejected = records.iloc[:0]
+    if not records.empty:
+        rejected = submit('journal', p_and_l_file_path, records).result(timeout=WRITE_TIMEOUT)
+        # Punches flushed together share one result; keep only ours
+        rejected = rejected[rejected['punch id'].isin(records['punch id'])]
+    if row_hashes is not None and not row_hashes.empty:
+        conflicted = pd.MultiIndex.from_frame(rejected[PNL_KEY_COLUMNS])
+        row_hashes = row_hashes[~pd.MultiIndex.from_frame(row_hashes[PNL_KEY_COLUMNS]).isin(conflicted)]
+        if not row_hashes.empty:
+            submit('punch hashes', p_and_l_file_path, row_hashes).result(timeout=WRITE_TIMEOUT)
+    return rejected
+
+def write_pnl_changes(p_and_l_file_path, changes, sheet=None, module=None, undo_of=None, row_hashes=None):
+    # Journaled now, folded into the workbook by the next compaction
+    return write_journaled(p_and_l_file_path, journal_records(changes, sheet, module, undo_of), row_hashes)
+
+def write_pnl_punches(p_and_l_file_path, punches, row_hashes=None):
+    # Several (changes, sheet, module) punches journaled in one append, each with its own punch id so it can be undone alone
+    records = pd.DataFrame(columns=JOURNAL_COLUMNS)
+    if punches:
+        records = pd.concat([journal_records(changes, sheet, module) for changes, sheet, module in punches], ignore_index=True)
+    return write_journaled(p_and_l_file_path, records, row_hashes)
+
+def watch_journal(p_and_l_file_path):
+    # Make sure a journal left behind by another process still gets compacted
+    _journaled_paths.add(p_and_l_file_path)
+    ensure_writer()
+
+def write_dump_rows(dump_file_path, new_rows, sheet=None, replace=False):
+    # Returns how many rows were skipped because the dump already had them; replace swaps out their partitions instead.
+    # Cast and hashed here, so rows that do not fit the dump schema fail only their own write and not the whole flush.
+    rows = conform_dump_rows(new_rows)
+    dump_id = uuid.uuid4().hex
+    # The legacy hash leaves the sheet out, matching the rows imported from Dump.xlsx
+    rows = rows.assign(**{'row hash': dump_row_hashes(rows, sheet), 'legacy hash': dump_row_hashes(rows), 'dump id': dump_id})
+    skipped = submit('dump replace' if replace else 'dump', dump_file_path, rows).result(timeout=WRITE_TIMEOUT)
+    return skipped.get(dump_id, 0)